@@ -21,8 +21,15 @@ setup(
     ],
     python_requires='>=3.7',
     install_requires=['gattlib'],
+    extras_require={
+        'numpy': ['numpy'],
+        'image': ['numpy', 'Pillow'],
+    },
+    entry_points={
+        'console_scripts': ['spotled=spotled.cli:main'],
+    },
     include_package_data=True,
     package_data={
-        "spotled": ["fonts/*.yaff"],
+        "spotled": ["fonts/*.yaff", "fonts/*.spf"],
     },
 )
@@ -1,44 +1,101 @@
-from gattlib import GATTRequester
-from threading import Event
+try:
+    from gattlib import GATTRequester
+except ImportError:
+    # gattlib is only needed to talk to real hardware. A different
+    # requester (such as spotled.simulator.SimulatedDevice) can be used without it.
+    GATTRequester = None
+from threading import Event, Lock
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Mapping
 from enum import Enum
+import hashlib
+import json
+import struct
 import time
 import os.path
 
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where the profile cache is only locked within a process
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, it is only needed to use arrays as bitmaps
+    np = None
+
+_SHORT = struct.Struct('>H')
+_INT = struct.Struct('>I')
+
+def _checksum(value):
+    """
+    Converts the byte sum of a record to its checksum byte.
+    """
+    if value > 255:
+        value = (~value) + 1
+    return value & 255
+
+def _serialize(record):
+    """
+    Serializes a data record into a buffer allocated at its exact size.
+    """
+    d = ByteWriter(record.encoded_size())
+    record.write(d)
+    return d.to_bytes()
+
+def _record_size(record):
+    if isinstance(record, (bytes, bytearray, memoryview)):
+        return len(record)
+    return record.encoded_size()
+
+def _write_record(d, record):
+    if isinstance(record, (bytes, bytearray, memoryview)):
+        d.write_bytes(record)
+    else:
+        record.write(d)
+
 class ByteWriter:
     """
     A class for writing bytes into binary blob by type sequentially.
     Also supports writing checksums for written data.
+    If the final size is known it can be passed in so that the
+    buffer is allocated once and written in place.
     """
-    def __init__(self):
-        self.content = bytearray()
+    def __init__(self, size=0):
+        self.content = bytearray(size)
+        self.pos = 0
         self.checksum_start_pos = 0
-    
+
     def write_byte(self, value):
-        self.content.append(value & 255)
+        if self.pos < len(self.content):
+            self.content[self.pos] = value & 255
+        else:
+            self.content.append(value & 255)
+        self.pos += 1
 
     def write_short(self, value):
-        self.content.append((value >> 8) & 255)
-        self.content.append(value & 255)
+        self.content[self.pos:self.pos+2] = _SHORT.pack(value & 0xffff)
+        self.pos += 2
 
     def write_int(self, value):
-        self.content.append((value >> 24) & 255)
-        self.content.append((value >> 16) & 255)
-        self.content.append((value >> 8) & 255)
-        self.content.append(value & 255)
-    
+        self.content[self.pos:self.pos+4] = _INT.pack(value & 0xffffffff)
+        self.pos += 4
+
     def write_bytes(self, value):
-        self.content.extend(value)
-    
+        length = len(value)
+        self.content[self.pos:self.pos+length] = value
+        self.pos += length
+
     def start_checksum(self):
-        self.checksum_start_pos = len(self.content)
+        self.checksum_start_pos = self.pos
 
     def write_checksum(self):
-        value = 0
-        for b in self.content[self.checksum_start_pos:]:
-            value += 255 & b
-        if value > 255:
-            value = (~value) + 1
-        self.content.append(value & 255)
+        with memoryview(self.content) as view:
+            value = sum(view[self.checksum_start_pos:self.pos])
+        self.write_byte(_checksum(value))
 
     def to_bytes(self):
         return bytes(self.content)
@@ -171,19 +228,33 @@ class SendDataCommand:
     This wraps ByteWriter and handles checksums for you.
     """
     def __init__(self, content):
+        """
+        Content can be already serialized data or a data
+        record such as AnimationData. Records are written
+        straight into the command buffer.
+        """
         self.serial_no = 1
         self.command_type = 32772
         self.content = content
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 15 + _record_size(self.content)
+
+    def to_buffer(self):
+        """
+        Serializes the command into a single newly allocated bytearray.
+        """
+        d = ByteWriter(self.encoded_size())
         d.write_int(15) # length of header
         d.write_short(self.command_type)
         d.write_int(self.serial_no)
-        d.write_int(len(self.content))
+        d.write_int(_record_size(self.content))
         d.write_checksum()
-        d.write_bytes(self.content)
-        return d.to_bytes()
+        _write_record(d, self.content)
+        return d.content
+
+    def serialize(self):
+        return bytes(self.to_buffer())
 
 class BrightnessData:
     """
@@ -193,13 +264,18 @@ class BrightnessData:
     def __init__(self, brightness):
         self.brightness = brightness
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 8
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(8) # length
         d.write_short(14) # type
         d.write_byte(self.brightness)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class ScreenModeData:
     """
@@ -209,13 +285,18 @@ class ScreenModeData:
     def __init__(self, mode):
         self.mode = mode
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 8
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(8) # length
         d.write_short(15)
         d.write_byte(self.mode)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class ScreenMode(Enum):
     NORMAL = 0
@@ -230,15 +311,20 @@ class FontData:
     def __init__(self, font_characters):
         self.font_characters = font_characters
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 9 + sum(font_character.encoded_size() for font_character in self.font_characters)
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(9) # length
         d.write_short(5) # type
         d.write_short(len(self.font_characters))
         d.write_checksum()
         for font_character in self.font_characters:
-            d.write_bytes(font_character.serialize())
-        return d.to_bytes()
+            font_character.write(d)
+
+    def serialize(self):
+        return _serialize(self)
 
 class FontCharacterData:
     """
@@ -251,8 +337,11 @@ class FontCharacterData:
         self.character = character
         self.bitmap = bitmap
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return len(self.bitmap) + 15
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(len(self.bitmap) + 15) # length
         d.write_short(13) # type
         d.write_byte(1) # always 1?
@@ -262,29 +351,92 @@ class FontCharacterData:
         d.write_byte(len(self.bitmap))
         d.write_bytes(self.bitmap)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
     
 
 def gen_color_bitmap(*lines, color_map={'.': (0, 0, 0), '1': (255, 255, 255)}):
     """
     Converts a "text" bitmap consisting of a predefined map of characters to a BGR tuple.
+    A single height x width x 3 numpy array of RGB pixels can also be passed instead of
+    the lines.
     """
-    data = bytearray()
-    for text in lines:
-        for i in range(0, len(text)):
-            color = color_map[text[i]]
-            data.append(color[0])
-            data.append(color[1])
-            data.append(color[2])
+    if len(lines) == 1 and _is_array(lines[0]):
+        return pack_color_bitmap(lines[0]).tobytes()
+
+    text = ''.join(lines)
+    try:
+        raw = text.encode('latin-1')
+        keys = ''.join(color_map).encode('latin-1')
+    except UnicodeEncodeError:
+        colors = {char: bytes(color) for char, color in color_map.items()}
+        return b''.join(map(colors.__getitem__, text))
+
+    unknown = raw.translate(None, keys)
+    if unknown:
+        raise KeyError(chr(unknown[0]))
+    # translate every character to one color channel at a time, interleaving the channels
+    data = bytearray(len(raw) * 3)
+    for channel in range(3):
+        table = bytearray(256)
+        for char, color in color_map.items():
+            table[ord(char)] = color[channel]
+        data[channel::3] = raw.translate(table)
     return bytes(data)
 
 
+def _is_array(value):
+    return np is not None and isinstance(value, np.ndarray)
+
+def pack_bitmap(pixels, min_len=0):
+    """
+    Packs a 2-D numpy array of pixels (nonzero is on) into
+    a uint8 array of bitmap rows. Rows are padded the same
+    way as gen_bitmap, so min_len sets the minimum row length.
+    """
+    if np is None:
+        raise ImportError('numpy is required to pack array bitmaps.')
+    pixels = np.asarray(pixels)
+    if pixels.ndim != 2:
+        raise ValueError('Bitmap arrays must be 2-D.')
+    if pixels.dtype != np.bool_:
+        pixels = pixels != 0
+    packed = np.packbits(pixels, axis=1)
+    min_bytes = (min_len + 7) // 8
+    if packed.shape[1] < min_bytes:
+        packed = np.pad(packed, ((0, 0), (0, min_bytes - packed.shape[1])))
+    return packed
+
+def pack_color_bitmap(pixels, palette=None):
+    """
+    Converts a height x width x 3 numpy array of RGB pixels into
+    a uint8 array of BGR pixels, the order devices expect. With a
+    palette (a sequence of BGR tuples, like the colors of
+    gen_color_bitmap), pixels is a 2-D array of palette indices.
+    """
+    if np is None:
+        raise ImportError('numpy is required to pack array bitmaps.')
+    pixels = np.asarray(pixels)
+    if palette is not None:
+        palette = np.asarray(palette, dtype=np.uint8)
+        if pixels.ndim != 2 or palette.ndim != 2 or palette.shape[1] != 3:
+            raise ValueError('Palette bitmaps must be 2-D arrays of indices into BGR colors.')
+        return np.take(palette, pixels, axis=0)
+    if pixels.ndim != 3 or pixels.shape[2] != 3:
+        raise ValueError('RGB bitmap arrays must be height x width x 3.')
+    return np.ascontiguousarray(pixels[:, :, ::-1], dtype=np.uint8)
+
 def gen_bitmap(*lines, min_len=0, true_char='1'):
     """
     Converts a "text" bitmap consisting of . and 1
     to a raw binary bitmap. min_len sets the minimum
-    row length.
+    row length. A single 2-D numpy array of pixels can
+    also be passed instead of the lines.
     """
+    if len(lines) == 1 and _is_array(lines[0]):
+        return pack_bitmap(lines[0], min_len).tobytes()
+
     if min_len % 8 != 0:
         min_len += 8 - (min_len % 8)
 
@@ -317,14 +469,19 @@ class TimeData:
     def __init__(self, time):
         self.time = time
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 10
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(10) # length
         d.write_short(7) # type
         d.write_byte(0) # always zero?
         d.write_short(self.time)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class SpeedData:
     """
@@ -333,13 +490,18 @@ class SpeedData:
     def __init__(self, speed):
         self.speed = speed
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 8
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(8) # length
         d.write_short(9) # type
         d.write_byte(self.speed)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class Effect(Enum):
     NONE = 0
@@ -364,13 +526,18 @@ class EffectData:
     def __init__(self, effect: Effect):
         self.effect = effect
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 8
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(8) # length
         d.write_short(8) # type
         d.write_byte(self.effect.value)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class FrameData:
     COLOR_DEPTH_MONOCHROME  = 1
@@ -380,15 +547,32 @@ class FrameData:
     from text consisting of ./1 or convert the lines to
     bytes in order. Also supports specifying a color
     depth but I have no such devices to test this on.
+
+    The bitmap can also be a numpy array. A 2-D array of
+    height x width pixels is packed, while an array that
+    is already packed (1-D, height x row bytes, or
+    height x width x 3 for RGB) is used without copying.
     """
     def __init__(self, width, height, bitmap, depth=1):
         self.width = width
         self.height = height
-        self.bitmap = bitmap
         self.depth = depth
+        if _is_array(bitmap):
+            bitmap = self._array_bitmap(bitmap)
+        self.bitmap = bitmap
 
-    def serialize(self):
-        d = ByteWriter()
+    def _array_bitmap(self, bitmap):
+        if self.depth == FrameData.COLOR_DEPTH_MONOCHROME and bitmap.shape == (self.height, self.width):
+            return memoryview(pack_bitmap(bitmap)).cast('B')
+        if bitmap.dtype != np.uint8:
+            raise ValueError('Packed bitmap arrays must be uint8.')
+        return memoryview(np.ascontiguousarray(bitmap)).cast('B')
+
+    def encoded_size(self):
+        return len(self.bitmap) + 12
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(len(self.bitmap) + 12) # length
         d.write_short(96) # type
         d.write_short(self.width)
@@ -396,7 +580,9 @@ class FrameData:
         d.write_byte(self.depth)
         d.write_bytes(self.bitmap)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class AnimationData:
     """
@@ -410,18 +596,24 @@ class AnimationData:
         self.speed = speed
         self.effects = effects
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        # header, frames, then time, speed and effect records
+        return 9 + sum(frame.encoded_size() for frame in self.frames) + 10 + 8 + 8
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(9) # length
         d.write_short(11) # type
         d.write_short(len(self.frames))
         d.write_checksum()
         for frame in self.frames:
-            d.write_bytes(frame.serialize())
-        d.write_bytes(TimeData(self.time).serialize())
-        d.write_bytes(SpeedData(self.speed).serialize())
-        d.write_bytes(EffectData(self.effects).serialize())
-        return d.to_bytes()
+            frame.write(d)
+        TimeData(self.time).write(d)
+        SpeedData(self.speed).write(d)
+        EffectData(self.effects).write(d)
+
+    def serialize(self):
+        return _serialize(self)
 
 class CharacterData:
     """
@@ -430,13 +622,18 @@ class CharacterData:
     def __init__(self, char):
         self.char = char
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 9
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(9) # length
         d.write_short(3) # type
         d.write_short(ord(self.char))
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
 
 class ColorData:
     """
@@ -447,15 +644,22 @@ class ColorData:
         self.green = green
         self.blue = blue
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return 10
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(10) # length
         d.write_short(2) # type
         d.write_byte(self.red)
         d.write_byte(self.green)
         d.write_byte(self.blue)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
+
+_WHITE = ColorData(255, 255, 255)
 
 class TextData:
     """
@@ -470,23 +674,35 @@ class TextData:
         self.speed = speed
         self.effects = effects
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        # header, a color and character record per character, then speed, time and effect records
+        if self.colors is not None:
+            colors_size = sum(self.colors[i].encoded_size() for i in range(len(self.text)))
+        else:
+            colors_size = 10 * len(self.text)
+        return 10 + colors_size + 9 * len(self.text) + 8 + 10 + 8
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(10) # length
         d.write_short(4) # type
         d.write_short(len(self.text))
         d.write_byte(1) # always 1?
         d.write_checksum()
+        character_data = CharacterData(None)
         for i, character in enumerate(self.text):
             if self.colors is not None:
-                d.write_bytes(self.colors[i].serialize())
+                self.colors[i].write(d)
             else:
-                d.write_bytes(ColorData(255, 255, 255).serialize())
-            d.write_bytes(CharacterData(character).serialize())
-        d.write_bytes(SpeedData(self.speed).serialize())
-        d.write_bytes(TimeData(0).serialize())
-        d.write_bytes(EffectData(self.effects).serialize())
-        return d.to_bytes()
+                _WHITE.write(d)
+            character_data.char = character
+            character_data.write(d)
+        SpeedData(self.speed).write(d)
+        TimeData(0).write(d)
+        EffectData(self.effects).write(d)
+
+    def serialize(self):
+        return _serialize(self)
 
 class NumberBarData:
     """
@@ -496,15 +712,145 @@ class NumberBarData:
     def __init__(self, values):
         self.values = values
 
-    def serialize(self):
-        d = ByteWriter()
+    def encoded_size(self):
+        return len(self.values) * 2 + 9
+
+    def write(self, d):
+        d.start_checksum()
         d.write_int(len(self.values) * 2 + 9) # length
         d.write_short(10) # type
         d.write_short(len(self.values))
         for value in self.values:
             d.write_short(value)
         d.write_checksum()
-        return d.to_bytes()
+
+    def serialize(self):
+        return _serialize(self)
+
+class DataTemplate:
+    """
+    A SendDataCommand which is encoded once and then updated in place.
+    For records that always have the same shape (such as NumberBarData),
+    patching changes only the given bytes and adjusts the checksums of
+    the record they belong to and of the command header, so sending a new
+    value doesn't build or serialize any records.
+
+    Templates can be passed to send_data like a SendDataCommand. Don't
+    patch a template from another thread while it is being sent.
+    """
+    def __init__(self, record):
+        self.command_type = 32772
+        self.buffer = SendDataCommand(record).to_buffer()
+        self._serial_no = 1
+        # the header sum without the serial number
+        self._header_sum = sum(self.buffer[0:6]) + sum(self.buffer[10:14])
+
+        # the content is a flat series of records which each start with
+        # their length and end with their checksum
+        self._records = []
+        self._sums = []
+        pos = 15
+        while pos < len(self.buffer):
+            end = pos + _INT.unpack_from(self.buffer, pos)[0]
+            self._records.append((pos, end - 1))
+            self._sums.append(sum(self.buffer[pos:end - 1]))
+            pos = end
+
+    @property
+    def serial_no(self):
+        return self._serial_no
+
+    @serial_no.setter
+    def serial_no(self, serial_no):
+        self._serial_no = serial_no
+        _INT.pack_into(self.buffer, 6, serial_no)
+        self.buffer[14] = _checksum(self._header_sum + sum(self.buffer[6:10]))
+
+    @property
+    def content(self):
+        return memoryview(self.buffer)[15:]
+
+    def _record_at(self, offset):
+        for i, (start, checksum_pos) in enumerate(self._records):
+            if start <= offset < checksum_pos:
+                return i
+        raise ValueError(f'Offset {offset} is not inside a record.')
+
+    def patch(self, offset, data):
+        """
+        Replaces bytes of the content (the serialized record, without the
+        command header) starting at offset. They must not span records.
+        """
+        offset += 15
+        i = self._record_at(offset)
+        end = offset + len(data)
+        if end > self._records[i][1]:
+            raise ValueError('Patched bytes span more than one record.')
+        delta = sum(data) - sum(self.buffer[offset:end])
+        self.buffer[offset:end] = data
+        if delta:
+            self._sums[i] += delta
+            self.buffer[self._records[i][1]] = _checksum(self._sums[i])
+
+    def encoded_size(self):
+        return len(self.buffer)
+
+    def to_buffer(self):
+        """
+        Returns a snapshot of the command.
+        """
+        return bytearray(self.buffer)
+
+    def serialize(self):
+        return bytes(self.buffer)
+
+class NumberBarTemplate(DataTemplate):
+    """
+    A template for streaming NumberBarData with a fixed number of values.
+    """
+    def __init__(self, count=16):
+        super().__init__(NumberBarData([0] * count))
+        self.count = count
+        self._values = struct.Struct(f'>{count}H')
+
+    def set_values(self, values):
+        if len(values) != self.count:
+            raise ValueError(f'Expected {self.count} values.')
+        self.patch(8, self._values.pack(*values))
+        return self
+
+class BrightnessTemplate(DataTemplate):
+    """
+    A template for BrightnessData.
+    """
+    def __init__(self, brightness=100):
+        super().__init__(BrightnessData(brightness))
+
+    def set_brightness(self, brightness):
+        self.patch(6, bytes((brightness,)))
+        return self
+
+class SpeedTemplate(DataTemplate):
+    """
+    A template for SpeedData.
+    """
+    def __init__(self, speed=0):
+        super().__init__(SpeedData(speed))
+
+    def set_speed(self, speed):
+        self.patch(6, bytes((speed,)))
+        return self
+
+class TimeTemplate(DataTemplate):
+    """
+    A template for TimeData.
+    """
+    def __init__(self, time=0):
+        super().__init__(TimeData(time))
+
+    def set_time(self, time):
+        self.patch(7, _SHORT.pack(time))
+        return self
 
 class GenericCommandResponse:
     """
@@ -543,6 +889,25 @@ class ContinueSendingResponse:
         self.continue_from = d.read_int()
 
         
+class SendingDataFinishResponse:
+    """
+    This response is sent from the device after a data command is finished.
+    A non-zero error code means the device did not accept the data.
+    """
+    def __init__(self, content):
+        d = ByteReader(content)
+        self.serial_no = d.read_short()
+        self.error_code = d.read_byte()
+        self.command_type = d.read_short()
+
+class TransferError(Exception):
+    """
+    Raised when the device rejects the data sent to it.
+    """
+    def __init__(self, error_code):
+        super().__init__(f'The device rejected the data (error {error_code}).')
+        self.error_code = error_code
+
 class PauseSendingResponse:
     """
     This response is sent from the device when it has an error reading sent data.
@@ -605,6 +970,9 @@ def getCommandResponse(data):
     if (response.command_type == 2):
         return SendingDataResponse(response.content)
 
+    if (response.command_type == 4 and len(response.content) == 5):
+        return SendingDataFinishResponse(response.content)
+
     if (response.command_type == 255):
         return ContinueSendingResponse(response.content)
 
@@ -622,6 +990,153 @@ def getCommandResponse(data):
 
     return response
 
+class Glyph:
+    """
+    An immutable character glyph. Rows are stored as integers with the
+    leftmost pixel in the highest bit. Glyphs padded to a given height
+    are created once and reused.
+    """
+    __slots__ = ('rows', 'width', 'height', '_lines', '_padded')
+
+    def __init__(self, rows, width):
+        self.rows = tuple(rows)
+        self.width = width
+        self.height = len(self.rows)
+        self._lines = None
+        self._padded = {}
+
+    @classmethod
+    def from_lines(cls, lines, true_char='1'):
+        """
+        Creates a glyph from "text" rows consisting of . and 1.
+        """
+        width = max((len(line) for line in lines), default=0)
+        rows = []
+        for line in lines:
+            if not line:
+                rows.append(0)
+                continue
+            try:
+                if true_char != '1':
+                    raise ValueError()
+                value = int(line.replace('.', '0'), 2)
+            except ValueError:
+                value = int(''.join('1' if c == true_char else '0' for c in line), 2)
+            rows.append(value << (width - len(line)))
+        return cls(rows, width)
+
+    def lines(self):
+        """
+        Returns the rows as "text" rows consisting of . and 1.
+        """
+        if self._lines is None:
+            if self.width:
+                self._lines = tuple(
+                    format(row, f'0{self.width}b').replace('0', '.') for row in self.rows
+                )
+            else:
+                self._lines = ('',) * self.height
+        return self._lines
+
+    def padded(self, height):
+        """
+        Returns the glyph centered vertically in at least height rows.
+        """
+        if self.height >= height:
+            return self
+        glyph = self._padded.get(height)
+        if glyph is None:
+            diff = height - self.height
+            rows = (0,) * (diff // 2 + diff % 2) + self.rows + (0,) * (diff // 2)
+            glyph = Glyph(rows, self.width)
+            self._padded[height] = glyph
+        return glyph
+
+    def pack(self, min_len=0):
+        """
+        Returns the glyph as a raw binary bitmap, the same as
+        passing its rows to gen_bitmap.
+        """
+        row_bytes = max(self.width + 7, min_len + 7) // 8
+        shift = row_bytes * 8 - self.width
+        return b''.join((row << shift).to_bytes(row_bytes, 'big') for row in self.rows)
+
+    # Glyphs can also be read like the list of rows fonts used to contain.
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, index):
+        return self.lines()[index]
+
+    def __iter__(self):
+        return iter(self.lines())
+
+    def __eq__(self, other):
+        if not isinstance(other, Glyph):
+            return NotImplemented
+        return self.width == other.width and self.rows == other.rows
+
+    def __hash__(self):
+        return hash((self.width, self.rows))
+
+    def __repr__(self):
+        return f'Glyph({self.width}x{self.height})'
+
+class Font(Mapping):
+    """
+    A font mapping characters to Glyphs. Characters that are not in the
+    font are drawn with the replacement character, null or space glyph.
+    """
+    __slots__ = ('glyphs', 'source', '_fallback')
+
+    def __init__(self, glyphs, source=None):
+        self.glyphs = glyphs
+        self.source = source
+        self._fallback = None
+
+    @classmethod
+    def from_dict(cls, font_data):
+        """
+        Creates a font from a dict of characters to "text" rows.
+        """
+        return cls({
+            char: glyph if isinstance(glyph, Glyph) else Glyph.from_lines(glyph)
+            for char, glyph in font_data.items()
+        })
+
+    def __getitem__(self, char):
+        return self.glyphs[char]
+
+    def __contains__(self, char):
+        return char in self.glyphs
+
+    def __iter__(self):
+        return iter(self.glyphs)
+
+    def __len__(self):
+        return len(self.glyphs)
+
+    def find(self, char):
+        """
+        Returns the glyph for a character, or the fallback glyph.
+        """
+        try:
+            return self[char]
+        except KeyError:
+            if self._fallback is None:
+                for fallback in ('\ufffd', '\x00', ' '):
+                    if fallback in self:
+                        self._fallback = self[fallback]
+                        break
+                else:
+                    raise
+            return self._fallback
+
+def _as_font(font_data):
+    if isinstance(font_data, Font):
+        return font_data
+    return Font.from_dict(font_data)
+
 def parse_yaff_font(fontfile):
     font = {}
     with open(fontfile) as fh:
@@ -640,7 +1155,7 @@ def parse_yaff_font(fontfile):
                 line_acc.append(line.replace('@', '1'))
         if current_char is not None:
             font[current_char] = line_acc
-    return font
+    return Font.from_dict(font)
 
 def parse_draw_font(fontfile):
     font = {}
@@ -660,32 +1175,111 @@ def parse_draw_font(fontfile):
                 line_acc.append(line.replace('#', '1').replace('-', '.'))
         if current_char is not None:
             font[current_char] = line_acc
-    return font
+    return Font.from_dict(font)
 
 def parse_font(fontfile):
+    if fontfile.endswith('.spf'):
+        from .fontbundle import load_font_bundle
+        return load_font_bundle(fontfile)
     if fontfile.endswith('.yaff'):
         return parse_yaff_font(fontfile)
     if fontfile.endswith('.draw'):
         return parse_draw_font(fontfile)
     raise TypeError('Unknown font type.')
 
-def find_and_load_font(font):
-    try_font = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', f'{font}.yaff')
-    if os.path.exists(try_font):
-        font = try_font
-    elif not os.path.exists(font):
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+
+class FontCache:
+    """
+    A bounded LRU cache of parsed fonts. Entries are keyed by the
+    resolved path along with the file modification time and size,
+    so a font is parsed again only if the file changes.
+    """
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.fonts = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            font = self.fonts.get(key)
+            if font is not None:
+                self.fonts.move_to_end(key)
+                return font
+
+        font = parse_font(path)
+        font.source = key
+        with self.lock:
+            for old_key in [k for k in self.fonts if k[0] == path]:
+                del self.fonts[old_key]
+            self.fonts[key] = font
+            while len(self.fonts) > self.max_size:
+                self.fonts.popitem(last=False)
+        return font
+
+    def invalidate(self, path=None):
+        """
+        Drops a single font from the cache, or all fonts if no path is given.
+        """
+        with self.lock:
+            if path is None:
+                self.fonts.clear()
+                return
+            path = os.path.realpath(path)
+            for old_key in [k for k in self.fonts if k[0] == path]:
+                del self.fonts[old_key]
+
+font_cache = FontCache()
+
+def find_font(font):
+    """
+    Returns the path of a bundled font by name (such as "6x12") or
+    of a font file. Bundled fonts are shipped precompiled.
+    """
+    for extension in ('.spf', '.yaff'):
+        try_font = os.path.join(FONT_DIR, f'{font}{extension}')
+        if os.path.exists(try_font):
+            return try_font
+    if not os.path.exists(font):
         raise FileNotFoundError('Could not find font file.')
-    return parse_font(font)
+    return font
+
+def find_and_load_font(font):
+    return font_cache.get(find_font(font))
+
+def preload_fonts(fonts=None):
+    """
+    Loads fonts into the font cache ahead of time. By default
+    this loads all of the bundled fonts.
+    """
+    if fonts is None:
+        fonts = [os.path.join(FONT_DIR, name) for name in sorted(os.listdir(FONT_DIR)) if name.endswith('.spf')]
+    for font in fonts:
+        find_and_load_font(font)
+
+def invalidate_font_cache(font=None):
+    """
+    Drops a font (or all fonts if none is given) from the font cache.
+    """
+    font_cache.invalidate(None if font is None else find_font(font))
 
 def pad_character_to_height(char_data, min_height, min_length=0):
+    """
+    Returns the glyph rows padded to at least min_height rows.
+    The font's own glyph is not modified, since fonts are cached.
+    """
     height = len(char_data)
     filler_line = '.' * min_length
     if height < min_height:
         diff = min_height - height
-        for _ in range(diff // 2 + diff % 2):
-            char_data.insert(0, filler_line)
-        for _ in range(diff // 2):
-            char_data.append(filler_line)
+        char_data = (
+            [filler_line] * (diff // 2 + diff % 2) +
+            list(char_data) +
+            [filler_line] * (diff // 2)
+        )
     return char_data
 
 def pad_row_to_width(row_data, min_width, align=Align.CENTER):
@@ -701,6 +1295,8 @@ def pad_row_to_width(row_data, min_width, align=Align.CENTER):
     return row_data
 
 def find_char_in_font(char, font_data):
+    if isinstance(font_data, Font):
+        return font_data.find(char)
     try:
         return font_data[char]
     except KeyError:
@@ -712,20 +1308,16 @@ def find_char_in_font(char, font_data):
             return font_data[' ']
 
 def create_font_characters(text, font_data, min_height=12):
+    font = _as_font(font_data)
     font_characters = []
     for char in text:
-        char_data = find_char_in_font(char, font_data)
-        height = len(char_data)
-        width = len(char_data[0])
-        if height < min_height:
-            pad_character_to_height(char_data, min_height)
-            height = min_height
-        if width < height:
-            width = height
-        font_characters.append(FontCharacterData(width, height, char, gen_bitmap(*char_data, min_len=width)))
+        glyph = font.find(char).padded(min_height)
+        width = max(glyph.width, glyph.height)
+        font_characters.append(FontCharacterData(width, glyph.height, char, glyph.pack(width)))
     return font_characters
 
 def reflow_text(text, font_data, width=48):
+    find = _as_font(font_data).find
     lines = text.replace('\r', '').split('\n')
     wrapped_lines = []
     for line in lines:
@@ -737,13 +1329,13 @@ def reflow_text(text, font_data, width=48):
             else:
                 word = orig_word
 
-            text_width = sum(len(find_char_in_font(char, font_data)[0]) for char in word)
+            text_width = sum(find(char).width for char in word)
             if remaining_width - text_width >= 0:
                 remaining_width -= text_width
                 current_line += word
             elif text_width > width:
                 for char in word:
-                    char_width = len(find_char_in_font(char, font_data)[0])
+                    char_width = find(char).width
                     if remaining_width - char_width >= 0:
                         remaining_width -= char_width
                         current_line += char
@@ -753,24 +1345,22 @@ def reflow_text(text, font_data, width=48):
                         current_line = char
             else:
                 wrapped_lines.append(current_line)
-                text_width = sum(len(find_char_in_font(char, font_data)[0]) for char in orig_word)
+                text_width = text_width - (find(' ').width if i != 0 else 0)
                 remaining_width = width - text_width
                 current_line = orig_word
         wrapped_lines.append(current_line)
     return wrapped_lines
 
 def lines_to_frames(lines, font_data, align=Align.CENTER, width=48, lines_per_frame=2, line_height=6):
+    find = _as_font(font_data).find
     raster_lines = []
     for line in lines:
         raster_line = ['' for _ in range(line_height)]
         for char in line:
-            char_data = find_char_in_font(char, font_data)
-            height = len(char_data)
-            if height > line_height:
+            glyph = find(char)
+            if glyph.height > line_height:
                 raise ValueError('Character height exceeds line height.')
-            if height < line_height:
-                pad_character_to_height(char_data, line_height, len(char_data[0]))
-            for i, char_line in enumerate(char_data):
+            for i, char_line in enumerate(glyph.padded(line_height).lines()):
                 raster_line[i] += char_line
         while len(raster_line[0]) > width:
             overflow_line = []
@@ -801,37 +1391,553 @@ def lines_to_frames(lines, font_data, align=Align.CENTER, width=48, lines_per_fr
 
     return raster_frames
 
-class LedConnection:
-    def __init__(self, address):
+def rasterize_lines(lines, font_data, align=Align.CENTER, width=48, lines_per_frame=2, line_height=6):
+    """
+    Renders lines of text into packed frame bitmaps. The result is the same
+    as passing each frame from lines_to_frames to gen_bitmap, but glyph rows
+    are combined with integer shifts instead of building "text" rows.
+    """
+    find = _as_font(font_data).find
+    row_bytes = (width + 7) // 8
+    row_padding = row_bytes * 8 - width
+
+    raster_lines = []
+    for line in lines:
+        rows = [0] * line_height
+        line_width = 0
+        for char in line:
+            glyph = find(char)
+            if glyph.height > line_height:
+                raise ValueError('Character height exceeds line height.')
+            glyph_width = glyph.width
+            for i, glyph_row in enumerate(glyph.padded(line_height).rows):
+                rows[i] = (rows[i] << glyph_width) | glyph_row
+            line_width += glyph_width
+        while line_width > width:
+            line_width -= width
+            mask = (1 << line_width) - 1
+            raster_lines.append([row >> line_width for row in rows])
+            rows = [row & mask for row in rows]
+        remaining = width - line_width
+        if remaining > 0:
+            if align == Align.LEFT:
+                rows = [row << remaining for row in rows]
+            elif align == Align.CENTER:
+                rows = [row << (remaining // 2 + remaining % 2) for row in rows]
+        raster_lines.append(rows)
+
+    blank_line = [0] * line_height
+    frames = []
+    for start in range(0, len(raster_lines), lines_per_frame):
+        frame_lines = raster_lines[start:start+lines_per_frame]
+        frame_lines.extend([blank_line] * (lines_per_frame - len(frame_lines)))
+        frames.append(b''.join(
+            (row << row_padding).to_bytes(row_bytes, 'big') for rows in frame_lines for row in rows
+        ))
+    return frames
+
+# Which part of the device state each type of data record replaces.
+RECORD_KINDS = {
+    4: 'display',       # TextData
+    10: 'display',      # NumberBarData
+    11: 'display',      # AnimationData
+    5: 'font',          # FontData
+    14: 'brightness',   # BrightnessData
+    15: 'screen_mode',  # ScreenModeData
+}
+
+def payload_kind(payload):
+    """
+    Returns the kind of device state (see RECORD_KINDS) that a serialized
+    SendDataCommand replaces, or None if it is not known.
+    """
+    if len(payload) < 21:
+        return None
+    return RECORD_KINDS.get((payload[19] << 8) | payload[20])
+
+_RECORD_CLASS_KINDS = {
+    TextData: 'display',
+    NumberBarData: 'display',
+    AnimationData: 'display',
+    FontData: 'font',
+    BrightnessData: 'brightness',
+    ScreenModeData: 'screen_mode',
+}
+
+def data_kind(data):
+    """
+    Returns the kind of device state (see RECORD_KINDS) that a SendDataCommand,
+    data record or serialized record replaces, or None if it is not known.
+    """
+    if isinstance(data, (SendDataCommand, DataTemplate)):
+        data = data.content
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        if len(data) < 6:
+            return None
+        return RECORD_KINDS.get((data[4] << 8) | data[5])
+    return _RECORD_CLASS_KINDS.get(type(data))
+
+class PayloadChunks:
+    """
+    Iterates over a serialized payload in chunks of up to chunk_size bytes.
+    Chunks are memoryview slices of the payload so nothing is copied, and
+    the position can be moved with seek (for example back to the offset
+    from ContinueSendingResponse) without serializing the payload again.
+    """
+    def __init__(self, payload, chunk_size):
+        self.view = memoryview(payload)
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= len(self.view):
+            raise StopIteration
+        chunk = self.view[self.pos:self.pos+self.chunk_size]
+        self.pos += len(chunk)
+        return chunk
+
+    def seek(self, pos):
+        self.pos = pos
+
+def render_text_lines(text, width, height, frame_limit=None, align=Align.CENTER, font="4x6", frame_duration=2,
+        line_height=6, effect=Effect.NONE, speed=20, reflow=True):
+    """
+    Renders multi-line text as an AnimationData record for a display of the given size.
+    Raises ValueError if the animation needs more frames than frame_limit.
+    """
+    font_data = find_and_load_font(font)
+
+    if reflow:
+        lines = reflow_text(text, font_data, width)
+    else:
+        lines = text.replace('\r', '').split('\n')
+
+    frames = rasterize_lines(lines, font_data, align, width, height // line_height, line_height)
+    if frame_limit is not None and len(frames) > frame_limit:
+        raise ValueError("The animation exceeds the device frame limit.")
+
+    return AnimationData(
+        [FrameData(width, height, frame) for frame in frames],
+        int(frame_duration * 1000),
+        speed,
+        effect
+    )
+
+def render_text(text, width, height, frame_limit=None, effect=Effect.SCROLL_LEFT, font="6x12", speed=0):
+    """
+    Renders single-line scrolling text as an AnimationData record.
+    """
+    return render_text_lines(
+        text,
+        width,
+        height,
+        frame_limit,
+        Align.LEFT,
+        font,
+        line_height=height,
+        effect=effect,
+        speed=speed,
+        reflow=False
+    )
+
+def split_animation(animation, frame_limit):
+    """
+    Splits an AnimationData record into records of at most frame_limit
+    frames each, which keep its time, speed and effect.
+    """
+    frames = animation.frames
+    return [
+        AnimationData(frames[i:i + frame_limit], animation.time, animation.speed, animation.effects)
+        for i in range(0, max(len(frames), 1), frame_limit)
+    ]
+
+def render_clear(width, height):
+    """
+    Renders an empty frame as an AnimationData record.
+    """
+    return AnimationData(
+        [FrameData(width, height, b'\x00' * int(width * height / 8))],
+        0,
+        0,
+        Effect.NONE
+    )
+
+class DeviceProfile:
+    """
+    The parameters of a device which LedConnection normally reads from it
+    on every connection: the characteristic handles, buffer size, display
+    info, (once queried) the version and the chunk size that worked best.
+    """
+    FIELDS = ('cmd_handle', 'data_handle', 'buffer_size', 'width', 'height', 'color_depth',
+        'frame_limit', 'brightness', 'font_info', 'version', 'chunk_size')
+    OPTIONAL_FIELDS = ('version', 'chunk_size')
+
+    def __init__(self, address, **fields):
+        self.address = address
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, address, fields):
+        profile = cls(address, **fields)
+        if any(getattr(profile, name) is None for name in cls.FIELDS if name not in cls.OPTIONAL_FIELDS):
+            raise ValueError('Incomplete device profile.')
+        return profile
+
+def default_profile_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'spotled', 'devices.json')
+
+class ProfileCache:
+    """
+    DeviceProfiles stored as JSON keyed by device address, by default in
+    $XDG_CACHE_HOME/spotled/devices.json. The file is read on every lookup
+    and replaced atomically on every change. Changes are made while holding
+    a lock on a .lock file next to it (where fcntl is available), so several
+    processes can share it without losing each other's updates.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or default_profile_cache_path()
+        self.lock = Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return {}
+        return data.get('devices', {})
+
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            if fcntl is None:
+                yield
+                return
+            with open(f'{self.path}.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, devices):
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as fh:
+            json.dump({'version': self.VERSION, 'devices': devices}, fh, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def get(self, address):
+        """
+        Returns the DeviceProfile of a device, or None if it is not cached.
+        """
+        fields = self._read().get(address.upper())
+        if fields is None:
+            return None
+        try:
+            return DeviceProfile.from_dict(address, fields)
+        except (TypeError, ValueError):
+            return None
+
+    def put(self, profile):
+        """
+        Stores the DeviceProfile of a device. The file is only rewritten if
+        the profile changed; returns whether it was.
+        """
+        fields = profile.to_dict()
+        with self._locked():
+            devices = self._read()
+            if devices.get(profile.address.upper()) == fields:
+                return False
+            devices[profile.address.upper()] = fields
+            self._write(devices)
+            return True
+
+    def remove(self, address=None):
+        """
+        Forgets a single device, or all devices if no address is given.
+        """
+        with self._locked():
+            devices = {} if address is None else self._read()
+            devices.pop(None if address is None else address.upper(), None)
+            self._write(devices)
+
+class TransferStats:
+    """
+    Statistics of a single send_data call. Times are in seconds, and counts
+    include every attempt. sent is False if the data was skipped (see
+    skip_unchanged) and None if sending failed, in which case error is set.
+    """
+    def __init__(self):
+        self.kind = None
+        self.sent = None
+        self.error = None
+        self.payload_bytes = 0
+        self.bytes_written = 0
+        self.chunks = 0
+        self.windows = 0
+        self.resumes = 0
+        self.attempts = 0
+        self.reconnects = 0
+        self.connect_time = 0
+        self.wait_time = 0
+        self.handshake_latency = None
+        self.duration = 0
+
+    @property
+    def bytes_per_sec(self):
+        """
+        The payload bytes sent per second, over the whole call.
+        """
+        if not self.sent or not self.duration:
+            return None
+        return self.payload_bytes / self.duration
+
+    def __repr__(self):
+        return (
+            f'TransferStats(kind={self.kind!r}, sent={self.sent}, bytes={self.payload_bytes}, '
+            f'chunks={self.chunks}, windows={self.windows}, resumes={self.resumes}, '
+            f'attempts={self.attempts}, reconnects={self.reconnects}, wait={self.wait_time:.3f}, '
+            f'duration={self.duration:.3f})'
+        )
+
+class ConnectionStats:
+    """
+    Totals over the lifetime of a connection. Times are in seconds.
+    """
+    def __init__(self):
+        self.transfers = 0
+        self.skipped = 0
+        self.failed = 0
+        self.payload_bytes = 0
+        self.bytes_written = 0
+        self.chunks = 0
+        self.windows = 0
+        self.resumes = 0
+        self.retries = 0
+        self.wait_time = 0
+        self.transfer_time = 0
+        self.queries = 0
+        self.query_retries = 0
+        self.query_time = 0
+        self.connects = 0
+        self.connect_time = 0
+
+    def add(self, transfer):
+        self.transfers += 1
+        if transfer.sent is False:
+            self.skipped += 1
+        elif transfer.sent is None:
+            self.failed += 1
+        self.payload_bytes += transfer.payload_bytes if transfer.sent else 0
+        self.bytes_written += transfer.bytes_written
+        self.chunks += transfer.chunks
+        self.windows += transfer.windows
+        self.resumes += transfer.resumes
+        self.retries += max(transfer.attempts - 1, 0)
+        self.wait_time += transfer.wait_time
+        self.transfer_time += transfer.duration
+
+    @property
+    def bytes_per_sec(self):
+        """
+        The payload bytes sent per second spent in send_data.
+        """
+        return self.payload_bytes / self.transfer_time if self.transfer_time else None
+
+class _LedProtocol:
+    """
+    Device state and protocol logic shared by LedConnection and AsyncLedConnection.
+
+    Exchanges with the device are generators which yield a (handle, data) tuple
+    for each write and None to wait for a response, which is sent back into
+    the generator. If no response arrives in time, TimeoutError is thrown into
+    the generator instead. The connection classes only carry out the writes and waits,
+    and keep how long the last wait took in last_wait.
+
+    Waiting for the device is given stall_retries more timeouts before a
+    transfer fails (an extended timeout, nothing is resent meanwhile, as data
+    writes carry no offset the device could place a resent window by). A paused
+    transfer resumes from the offset the device reports, up to resume_limit
+    times per transfer.
+
+    A larger MTU (requested_mtu) is requested when the requester supports
+    exchange_mtu. Chunks start at the largest size the MTU and buffer allow;
+    pauses, retransmissions and timeouts shrink them, and after probe_after
+    transfers without trouble they are grown again. The chunk size that worked
+    is kept in the device profile.
+
+    Every send_data call is measured in a TransferStats, which is kept as
+    last_transfer, added to the totals in stats (a ConnectionStats) and passed
+    to on_transfer if it is set.
+    """
+    stall_retries = 2
+    resume_limit = 100
+    requested_mtu = 247
+    min_chunk_size = 20
+    probe_after = 8
+    on_transfer = None
+
+    def _init_state(self, skip_unchanged):
         self.mtu = 23
-        self.connection = GATTRequester(address)
-        self.connection.on_connect = lambda mtu: self._set_mtu(mtu)
-        self._ensure_connection()
-        self.connection.write_by_handle(0x0f, b'\x00\x00\x00\x01') # request notifications
-        self.connection.on_notification = lambda handle, data: self._on_notification(handle, data)
-        self.cmd_handle, self.data_handle = _discover_handles(self.connection)
-        
-        self.current_wait_event = Event()
-        self.last_data = None
+        self.skip_unchanged = skip_unchanged
+        self.sent_digests = {}
+        # character -> (font, height) of glyphs uploaded since connecting
+        self.resident_glyphs = {}
+        # the FontData command from the last _glyph_upload
+        self.glyph_command = None
         self.data_serial_no = 0
         self.command_serial_no = 0
-
-        self.buffer_size = self.query_command(GetBufferSizeCommand()).buffer_size
-        display_info = self.query_command(GetDisplayInfoCommand())
+        self.templates = {}
+        self.profile_cache = None
+        # the profile as last loaded from or saved to the cache
+        self.cached_profile = None
+        self.profile_validated = True
+        self._version = None
+        self.mtu_negotiated = False
+        # None until a transfer has trouble, then the adapted chunk size
+        self.chunk_size = None
+        self.clean_transfers = 0
+        self.stats = ConnectionStats()
+        self.last_transfer = None
+        self.last_wait = 0
+
+    def _set_display_info(self, display_info):
         self.width = display_info.width
         self.height = display_info.height
         self.frame_limit = display_info.frame_limit
         self.brightness = display_info.brightness
         self.color_depth = display_info.color_depth
+        self.font_info = display_info.font_info
 
-    def _on_notification(self, handle, data):
-        if handle == self.cmd_handle:
-            self.last_data = data
-            self.current_wait_event.set()
+    def _use_profile_cache(self, profile_cache):
+        """
+        Returns the cached profile of the device (or None) and keeps the cache for saving later.
+        """
+        if profile_cache is True:
+            profile_cache = ProfileCache()
+        self.profile_cache = profile_cache
+        if profile_cache is None:
+            return None
+        return profile_cache.get(self.address)
+
+    def _apply_profile(self, profile):
+        self.cmd_handle = profile.cmd_handle
+        self.data_handle = profile.data_handle
+        self.buffer_size = profile.buffer_size
+        self.width = profile.width
+        self.height = profile.height
+        self.color_depth = profile.color_depth
+        self.frame_limit = profile.frame_limit
+        self.brightness = profile.brightness
+        self.font_info = profile.font_info
+        if profile.version is not None:
+            self._version = VersionResponse(bytes(3) + struct.pack('>HII', *profile.version))
+        self.chunk_size = profile.chunk_size
+        self.cached_profile = profile.to_dict()
+        # checked against the device the first time something goes wrong
+        self.profile_validated = False
+
+    def profile(self):
+        """
+        Returns the DeviceProfile of the connected device.
+        """
+        version = self._version
+        return DeviceProfile(
+            self.address, cmd_handle=self.cmd_handle, data_handle=self.data_handle,
+            buffer_size=self.buffer_size, width=self.width, height=self.height,
+            color_depth=self.color_depth, frame_limit=self.frame_limit, brightness=self.brightness,
+            font_info=self.font_info, chunk_size=self.chunk_size,
+            version=None if version is None else
+                [version.device_type, version.device_revision, version.software_revision]
+        )
+
+    def _save_profile(self):
+        if self.profile_cache is None:
+            return
+        profile = self.profile()
+        if profile.to_dict() != self.cached_profile:
+            self.profile_cache.put(profile)
+            self.cached_profile = profile.to_dict()
 
     def _set_mtu(self, mtu):
         self.mtu = mtu
-    
+
+    def _negotiate_mtu(self):
+        """
+        Asks for a larger MTU if the requester can, once per connection.
+        """
+        self.mtu_negotiated = True
+        exchange_mtu = getattr(self.connection, 'exchange_mtu', None)
+        if exchange_mtu is None or not self.requested_mtu:
+            return
+        try:
+            mtu = exchange_mtu(self.requested_mtu)
+        except Exception:
+            # not supported by this backend or device
+            return
+        if isinstance(mtu, int) and mtu >= 23:
+            self._set_mtu(mtu)
+
+    def _send_size(self):
+        send_size = min(self.mtu - 3, self.buffer_size)
+        if self.chunk_size is not None:
+            send_size = min(send_size, self.chunk_size)
+        return max(send_size, 1)
+
+    def _shrink_chunks(self):
+        send_size = self._send_size()
+        self.chunk_size = max(min(self.min_chunk_size, send_size), send_size * 3 // 4)
+        self.clean_transfers = 0
+
+    def _transfer_done(self, clean):
+        """
+        Grows the chunk size again after enough transfers without trouble,
+        and keeps it in the profile once it has worked.
+        """
+        if not clean:
+            self.clean_transfers = 0
+            return
+        self.clean_transfers += 1
+        if self.chunk_size is None:
+            return
+        if self.clean_transfers >= self.probe_after:
+            self.clean_transfers = 0
+            largest = min(self.mtu - 3, self.buffer_size)
+            self.chunk_size = min(largest, self.chunk_size + max(1, self.chunk_size // 4))
+        if self.profile_cache is not None and self.clean_transfers == 1:
+            self._save_profile()
+
+    def _template(self, key, factory):
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = factory()
+        return template
+
+    def _brightness_command(self, brightness):
+        return self._template('brightness', BrightnessTemplate).set_brightness(brightness)
+
+    def _number_bars_command(self, values):
+        return self._template(('number_bars', len(values)), lambda: NumberBarTemplate(len(values))).set_values(values)
+
+    def _clear_command(self):
+        return self._template(('clear', self.width, self.height),
+            lambda: DataTemplate(render_clear(self.width, self.height)))
+
     def _next_data_serial_no(self):
         self.data_serial_no = (self.data_serial_no + 1) & 0xffffffff
         return self.data_serial_no
@@ -840,8 +1946,237 @@ class LedConnection:
         self.command_serial_no = (self.command_serial_no + 1) & 0xffff
         return self.command_serial_no
 
+    def _write_data(self, handle, data):
+        # gattlib needs bytes, other requesters can take a memoryview as is
+        if isinstance(data, memoryview) and not getattr(self.connection, 'accepts_buffers', False):
+            data = bytes(data)
+        self.connection.write_cmd(handle, data)
+
+    def invalidate_send_cache(self, kind=None):
+        """
+        Forgets what was sent to the device, so that the next update of
+        this kind (or of any kind) is always sent. This includes the glyphs
+        uploaded by set_text_by_chars. Use this if the device may have been reset.
+        """
+        if kind is None:
+            self.sent_digests.clear()
+        else:
+            self.sent_digests.pop(kind, None)
+        if kind is None or kind == 'font':
+            self._forget_glyphs()
+
+    def _forget_glyphs(self):
+        self.resident_glyphs.clear()
+        self.sent_digests.pop('font', None)
+
+    def _remember_sent(self, kind, digest, data_command):
+        if kind is None:
+            # unknown data may have changed anything
+            self._forget_glyphs()
+            self.sent_digests.clear()
+            return
+        if kind == 'font':
+            if data_command is not self.glyph_command:
+                # glyphs sent some other way may have replaced the resident ones
+                self._forget_glyphs()
+            # text on the display may use the replaced glyphs
+            self.sent_digests.pop('display', None)
+        self.sent_digests[kind] = digest
+
+    def _start_transfer(self):
+        return TransferStats(), time.perf_counter(), self.stats.connects, self.stats.connect_time
+
+    def _finish_transfer(self, transfer, start, connects, connect_time):
+        transfer.duration = time.perf_counter() - start
+        transfer.reconnects = self.stats.connects - connects
+        transfer.connect_time = self.stats.connect_time - connect_time
+        self.last_transfer = transfer
+        self.stats.add(transfer)
+        if self.on_transfer is not None:
+            self.on_transfer(transfer)
+
+    def _data_transfer(self, data_command, force=False, stats=None):
+        if stats is None:
+            stats = TransferStats()
+        data_command.serial_no = self._next_data_serial_no()
+        serial_no = self._next_command_serial_no()
+
+        if hasattr(data_command, 'to_buffer'):
+            payload = data_command.to_buffer()
+        else:
+            payload = data_command.serialize()
+
+        kind = payload_kind(payload)
+        stats.kind = kind
+        stats.payload_bytes = len(payload)
+        with memoryview(payload) as view:
+            digest = hashlib.blake2b(view[15:], digest_size=16).digest()
+        if self.skip_unchanged and not force and kind is not None and self.sent_digests.get(kind) == digest:
+            return False
+        self.sent_digests.pop(kind, None)
+
+        yield self.cmd_handle, SendingDataStartCommand(serial_no, data_command.command_type, len(payload)).serialize()
+        waited = stats.wait_time
+        response = yield from self._wait_for(stats, serial_no, SendingDataResponse)
+        stats.handshake_latency = stats.wait_time - waited
+        assert response.command_type == data_command.command_type
+        assert response.error_code == 0
+
+        sent_payloads = 0
+        send_size = self._send_size()
+        send_count = self.buffer_size // send_size
+        chunks = PayloadChunks(payload, send_size)
+        window_start = 0
+        resumes = 0
+        clean = True
+
+        for chunk in chunks:
+            yield self.data_handle, chunk
+            sent_payloads += 1
+            stats.chunks += 1
+            stats.bytes_written += len(chunk)
+
+            if sent_payloads >= send_count:
+                sent_payloads = 0
+                response = yield from self._wait_for(stats, serial_no, ContinueSendingResponse, PauseSendingResponse)
+                stats.windows += 1
+                assert response.command_type == data_command.command_type
+                if type(response) == PauseSendingResponse:
+                    # the offset is relative to the start of the window being paused
+                    resumes += 1
+                    if resumes > self.resume_limit:
+                        raise TimeoutError("The device kept pausing the data transfer.")
+                    position = window_start + response.offset
+                else:
+                    position = response.continue_from
+                if position < chunks.pos:
+                    # data was lost, so send smaller chunks from here
+                    clean = False
+                    stats.resumes += 1
+                    self._shrink_chunks()
+                    send_size = chunks.chunk_size = self._send_size()
+                    send_count = self.buffer_size // send_size
+                chunks.seek(position)
+                window_start = position
+
+        yield self.cmd_handle, SendingDataFinishCommand(serial_no, data_command.command_type, len(payload)).serialize()
+        response = yield from self._wait_for(stats, serial_no)
+        if type(response) == SendingDataFinishResponse and response.error_code != 0:
+            raise TransferError(response.error_code)
+        self._remember_sent(kind, digest, data_command)
+        self._transfer_done(clean)
+        return True
+
+    def _wait_for(self, stats, serial_no, *response_types):
+        """
+        Waits for a response of one of the given types (or of any type) to the
+        transfer with serial_no, ignoring late responses to earlier transfers.
+        Up to stall_retries timeouts are waited out before the last one is raised.
+        """
+        stalls = 0
+        while True:
+            try:
+                response = yield None
+            except TimeoutError:
+                stats.wait_time += self.last_wait
+                stalls += 1
+                if stalls > self.stall_retries:
+                    raise
+                continue
+            stats.wait_time += self.last_wait
+            if getattr(response, 'serial_no', serial_no) != serial_no:
+                continue
+            assert not response_types or type(response) in response_types
+            return response
+
+    def _glyph_upload(self, text, font_data):
+        """
+        Returns the FontData command for the glyphs of the text which are not
+        on the device yet (or None), the characters it uploads and their key.
+        """
+        glyph_key = (font_data.source, self.height)
+        missing = [
+            char for char in dict.fromkeys(text)
+            if self.resident_glyphs.get(char) != glyph_key
+        ]
+        if not missing:
+            return None, missing, glyph_key
+        font_characters = create_font_characters(missing, font_data, self.height)
+        self.glyph_command = SendDataCommand(FontData(font_characters))
+        return self.glyph_command, missing, glyph_key
+
+    def _set_resident(self, chars, glyph_key):
+        for char in chars:
+            self.resident_glyphs[char] = glyph_key
+
+class LedConnection(_LedProtocol):
+    """
+    A connection to a single device. By default this connects using gattlib's
+    GATTRequester, but any object with the same interface can be passed as the
+    requester (see spotled.simulator for a software device).
+
+    With skip_unchanged, data that is identical to what the device last
+    acknowledged for the same kind of state (display contents, font,
+    brightness or screen mode) is not sent again.
+
+    With a profile_cache (a ProfileCache, or True for the default one), the
+    handles and display parameters are read from the cache instead of the
+    device if it has been connected to before. They are read from the device
+    again if a transfer fails, or with refresh_profile.
+    """
+    def __init__(self, address, requester=None, skip_unchanged=False, profile_cache=None):
+        self._init_state(skip_unchanged)
+        self.address = address
+        if requester is None:
+            if GATTRequester is None:
+                raise ImportError('gattlib is required to connect to a bluetooth device.')
+            requester = GATTRequester(address)
+        self.connection = requester
+        self.connection.on_connect = lambda mtu: self._set_mtu(mtu)
+        self.current_wait_event = Event()
+        self.last_data = None
+
+        profile = self._use_profile_cache(profile_cache)
+        self._ensure_connection()
+        self.connection.write_by_handle(0x0f, b'\x00\x00\x00\x01') # request notifications
+        self.connection.on_notification = lambda handle, data: self._on_notification(handle, data)
+        if profile is not None:
+            self._apply_profile(profile)
+        else:
+            self.refresh_profile()
+
+    def refresh_profile(self):
+        """
+        Reads the handles and display parameters from the device
+        (and updates the profile cache if there is one).
+        """
+        self.cmd_handle, self.data_handle = _discover_handles(self.connection)
+        self.buffer_size = self.query_command(GetBufferSizeCommand()).buffer_size
+        self._set_display_info(self.query_command(GetDisplayInfoCommand()))
+        self.profile_validated = True
+        self._save_profile()
+
+    @property
+    def version(self):
+        """
+        The VersionResponse of the device, queried the first time it is used.
+        """
+        if self._version is None:
+            self._version = self.query_command(GetVersionCommand())
+            self._save_profile()
+        return self._version
+
+    def _on_notification(self, handle, data):
+        if handle == self.cmd_handle:
+            self.last_data = data
+            self.current_wait_event.set()
+
     def _ensure_connection(self):
         if not self.connection.is_connected():
+            self._forget_glyphs()
+            self.mtu_negotiated = False
+            self.stats.connects += 1
+            started = time.perf_counter()
             try:
                 self.connection.connect()
             except:
@@ -852,7 +2187,33 @@ class LedConnection:
                     break
                 time.sleep(0.1)
             else:
+                self.stats.connect_time += time.perf_counter() - started
                 raise TimeoutError("Timeout exceeded waiting for bluetooth connection.")
+            self.stats.connect_time += time.perf_counter() - started
+        if not self.mtu_negotiated:
+            self._negotiate_mtu()
+
+    def _run(self, steps, timeout):
+        response = None
+        error = None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(response)
+            except StopIteration as stop:
+                return stop.value
+            response = None
+            error = None
+            if step is None:
+                started = time.perf_counter()
+                try:
+                    response = self.wait_for_response(timeout)
+                    self.current_wait_event.clear()
+                except TimeoutError as e:
+                    error = e
+                self.last_wait = time.perf_counter() - started
+            else:
+                self.current_wait_event.clear()
+                self._write_data(*step)
 
     def send_command(self, command):
         """
@@ -868,16 +2229,22 @@ class LedConnection:
         Send a control command to the device and wait for a response.
         Used for basic commands and data sending flow control.
         """
-        for i in range(attempts + 1):
-            try:
-                self._ensure_connection()
-                self.current_wait_event.clear()
-                self.connection.write_cmd(self.cmd_handle, command.serialize())
-                return self.wait_for_response(timeout)
-            except TimeoutError:
-                if i == attempts:
-                    raise
-                self.connection.disconnect()
+        self.stats.queries += 1
+        started = time.perf_counter()
+        try:
+            for i in range(attempts + 1):
+                try:
+                    self._ensure_connection()
+                    self.current_wait_event.clear()
+                    self.connection.write_cmd(self.cmd_handle, command.serialize())
+                    return self.wait_for_response(timeout)
+                except TimeoutError:
+                    if i == attempts:
+                        raise
+                    self.stats.query_retries += 1
+                    self.connection.disconnect()
+        finally:
+            self.stats.query_time += time.perf_counter() - started
 
     def wait_for_response(self, timeout=0.2):
         """
@@ -887,138 +2254,126 @@ class LedConnection:
             raise TimeoutError("Timeout exceeded waiting for GATT response.")
         return getCommandResponse(self.last_data)
 
-    def _send_data_internal(self, data_command, timeout=0.2):
+    def _send_data_internal(self, data_command, timeout=0.2, force=False, stats=None):
         self._ensure_connection()
-        data_command.serial_no = self._next_data_serial_no()
-        serial_no = self._next_command_serial_no()
+        return self._run(self._data_transfer(data_command, force, stats), timeout)
 
-        payload = data_command.serialize()
-        self.send_command(SendingDataStartCommand(serial_no, data_command.command_type, len(payload)))
-        response = self.wait_for_response(timeout)
-        assert type(response) == SendingDataResponse
-        assert response.serial_no == serial_no
-        assert response.command_type == data_command.command_type
-        assert response.error_code == 0
-
-        seek = 0
-        sent_payloads = 0
-        send_size = self.mtu - 3
-        send_count = self.buffer_size // send_size
-
-        while seek < len(payload):
-            self.current_wait_event.clear()
-            self.connection.write_cmd(self.data_handle, payload[seek:seek+send_size])
-            sent_payloads += 1
-            seek += send_size
-
-            if sent_payloads >= send_count:
-                sent_payloads = 0
-                response = self.wait_for_response(timeout)
-                assert type(response) == ContinueSendingResponse
-                assert response.serial_no == serial_no
-                assert response.command_type == data_command.command_type
-                seek = response.continue_from
-        
-        self.send_command(SendingDataFinishCommand(serial_no, data_command.command_type, len(payload)))
-        self.wait_for_response(timeout)
-
-    def send_data(self, data_command, timeout=0.2, attempts=5):
+    def send_data(self, data_command, timeout=0.2, attempts=5, force=False):
         """
         Send a data command to the device.
         Currently only SendDataCommand is used, which accepts raw serialized data.
+        Returns False if the data was skipped because the device already has it
+        (see skip_unchanged), unless force is set.
+
+        Paused transfers resume from the offset the device reports, and waits for
+        the device allow for stall_retries extra timeouts. If a transfer still
+        fails or the device rejects the data, it is restarted from the beginning,
+        first on the same connection and then after reconnecting, up to attempts times.
         """
-        for i in range(attempts + 1):
-            try:
-                self._send_data_internal(data_command, timeout)
-                return
-            except TimeoutError:
-                if i == attempts:
-                    raise
-                self.connection.disconnect()
+        transfer, *started = self._start_transfer()
+        try:
+            for i in range(attempts + 1):
+                transfer.attempts += 1
+                try:
+                    transfer.sent = self._send_data_internal(data_command, timeout, force, transfer)
+                    return transfer.sent
+                except (TimeoutError, TransferError):
+                    if i == attempts:
+                        raise
+                    self._shrink_chunks()
+                    if not self.profile_validated:
+                        # the cached profile may be out of date
+                        self._ensure_connection()
+                        self.refresh_profile()
+                    elif i > 0 or not self.connection.is_connected():
+                        self.connection.disconnect()
+        except Exception as e:
+            transfer.error = e
+            raise
+        finally:
+            self._finish_transfer(transfer, *started)
 
     def set_brightness(self, brightness):
         """
         Sets the display brightness. 0 is lowest and 100 is highest.
         """
-        self.send_data(SendDataCommand(BrightnessData(brightness).serialize()))
+        self.send_data(self._brightness_command(brightness))
         self.brightness = brightness
 
     def set_screen_mode(self, mode: ScreenMode):
         """
         This allows flipping and mirroring the display. See ScreenMode Enum.
         """
-        self.send_data(SendDataCommand(ScreenModeData(mode.value).serialize()))
+        self.send_data(SendDataCommand(ScreenModeData(mode.value)))
+
+    def set_number_bars(self, values):
+        """
+        Graphs 16 values from 0-12 as a bar graph, such as a music spectrum.
+        """
+        self.send_data(self._number_bars_command(values))
 
     def set_text_by_chars(self, text, effect=Effect.SCROLL_LEFT, font="6x12", speed=0, char_limit=72):
         """
         Sends text as characters. The device decides how to display them.
         This tends to be slower and more limited than set_text which sends the text as an animation.
+        Only glyphs that have not already been sent to the device since connecting are uploaded.
         """
         if len(text) > char_limit:
             raise ValueError("The text exceeds the device character limit.")
 
         font_data = find_and_load_font(font)
-        font_characters = create_font_characters(text, font_data, self.height)
-        font_character_data = SendDataCommand(FontData(font_characters).serialize())
-        text_data = SendDataCommand(TextData(text, speed, effect).serialize())
-        self.send_data(font_character_data)
-        self.send_data(text_data)
+        # reconnecting forgets the resident glyphs, so do it before checking them
+        self._ensure_connection()
+        font_command, chars, glyph_key = self._glyph_upload(text, font_data)
+        if font_command is not None:
+            self.send_data(font_command)
+            self._set_resident(chars, glyph_key)
+
+        self.send_data(SendDataCommand(TextData(text, speed, effect)))
 
     def set_text_lines(self, text, align=Align.CENTER, font="4x6", frame_duration=2, line_height=6,
-            effect=Effect.NONE, speed=20, reflow=True):
+            effect=Effect.NONE, speed=20, reflow=True, sequence=False):
         """
         Sends multi-line text as an animation. Can pack two lines of text onto the display.
-        """
-        font_data = find_and_load_font(font)
-
-        if reflow:
-            lines = reflow_text(text, font_data, self.width)
-        else:
-            lines = text.replace('\r', '').split('\n')
-
-        frames = lines_to_frames(lines, font_data, align, self.width, self.height // line_height, line_height)
-        if len(frames) > self.frame_limit:
-            raise ValueError("The animation exceeds the device frame limit.")
-
-        frame_data = SendDataCommand(
-            AnimationData(
-                [FrameData(self.width, self.height, gen_bitmap(*frame)) for frame in frames],
-                int(frame_duration * 1000),
-                speed,
-                effect
-            ).serialize()
-        )
 
-        self.send_data(frame_data)
+        With sequence, text longer than the device frame limit is played in segments from
+        a background thread, and the spotled.sequencer.Sequencer doing so is returned.
+        """
+        if sequence:
+            from .sequencer import Sequencer
+            return Sequencer(self, render_text_lines(
+                text, self.width, self.height, None, align, font, frame_duration, line_height, effect,
+                speed, reflow
+            ))
+        self.send_data(SendDataCommand(render_text_lines(
+            text, self.width, self.height, self.frame_limit, align, font, frame_duration,
+            line_height, effect, speed, reflow
+        )))
 
     def set_text(self, text, effect=Effect.SCROLL_LEFT, font="6x12", speed=0):
         """
         Sends single-line scrolling text as an animation.
         """
-        self.set_text_lines(
-            text,
-            Align.LEFT,
-            font,
-            line_height=self.height,
-            effect=effect,
-            speed=speed,
-            reflow=False
-        )
+        self.send_data(SendDataCommand(render_text(
+            text, self.width, self.height, self.frame_limit, effect, font, speed
+        )))
+
+    def set_image(self, source, fit='contain', dither=None, threshold=128, invert=False,
+            effect=Effect.NONE, speed=20, frame_duration=None):
+        """
+        Sends an image or animated GIF (a path, file or PIL image) as an animation. Needs Pillow and numpy.
+        """
+        from .image import image_to_animation
+        self.send_data(SendDataCommand(image_to_animation(
+            source, self.width, self.height, self.color_depth, self.frame_limit, fit, dither,
+            threshold, invert, effect, speed, frame_duration
+        )))
 
     def clear(self):
         """
         Clears the display by sending an empty frame.
         """
-        frame_data = SendDataCommand(
-            AnimationData(
-                [FrameData(self.width, self.height, b'\x00' * int(self.width * self.height / 8))],
-                0,
-                0,
-                Effect.NONE
-            ).serialize()
-        )
-
-        self.send_data(frame_data)
+        self.send_data(self._clear_command())
 
     def disconnect(self):
         self.connection.disconnect()
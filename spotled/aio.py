@@ -0,0 +1,323 @@
+"""
+An asyncio counterpart to LedConnection.
+"""
+import asyncio
+import functools
+import time
+
+from . import (
+    GATTRequester, _LedProtocol, _discover_handles, getCommandResponse, find_and_load_font,
+    render_text_lines, render_text, Align, Effect, ScreenMode,
+    SendDataCommand, ScreenModeData, TextData,
+    GetBufferSizeCommand, GetDisplayInfoCommand, GetVersionCommand, TransferError
+)
+
+
+class AsyncLedConnection(_LedProtocol):
+    """
+    A connection to a single device for use with asyncio. Create it with
+    `await AsyncLedConnection.create(address)`.
+
+    Responses are delivered through futures which are resolved from the
+    notification callback, so waiting for the device does not block a thread.
+    Blocking requester calls (connecting, service discovery and writes) are run
+    in the default executor, with the writes of a window in a single call.
+    Operations on one connection are serialized by a lock, so it is safe to
+    use from several tasks.
+
+    profile_cache works as for LedConnection.
+    """
+    def __init__(self, address, requester=None, skip_unchanged=False):
+        self._init_state(skip_unchanged)
+        self.address = address
+        self.connection = requester
+        self.loop = None
+        self.last_data = None
+
+    @classmethod
+    async def create(cls, address, requester=None, skip_unchanged=False, profile_cache=None):
+        """
+        Connects to the device and reads its display parameters.
+        """
+        self = cls(address, requester, skip_unchanged)
+        await self._setup(profile_cache)
+        return self
+
+    async def _setup(self, profile_cache):
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        self.response = self.loop.create_future()
+
+        if self.connection is None:
+            if GATTRequester is None:
+                raise ImportError('gattlib is required to connect to a bluetooth device.')
+            self.connection = await self._in_thread(GATTRequester, self.address)
+        self.connection.on_connect = lambda mtu: self._set_mtu(mtu)
+        profile = await self._in_thread(self._use_profile_cache, profile_cache)
+        await self._ensure_connection()
+        await self._in_thread(self.connection.write_by_handle, 0x0f, b'\x00\x00\x00\x01') # request notifications
+        self.connection.on_notification = lambda handle, data: self._on_notification(handle, data)
+        if profile is not None:
+            self._apply_profile(profile)
+        else:
+            await self.refresh_profile()
+
+    async def refresh_profile(self):
+        """
+        Reads the handles and display parameters from the device
+        (and updates the profile cache if there is one).
+        """
+        async with self.lock:
+            await self._refresh_profile()
+
+    async def _refresh_profile(self):
+        self.cmd_handle, self.data_handle = await self._in_thread(_discover_handles, self.connection)
+        self.buffer_size = (await self._query_command(GetBufferSizeCommand())).buffer_size
+        self._set_display_info(await self._query_command(GetDisplayInfoCommand()))
+        self.profile_validated = True
+        await self._in_thread(self._save_profile)
+
+    async def get_version(self):
+        """
+        Returns the VersionResponse of the device, queried the first time it is needed.
+        """
+        if self._version is None:
+            self._version = await self.query_command(GetVersionCommand())
+            await self._in_thread(self._save_profile)
+        return self._version
+
+    def _in_thread(self, func, *args):
+        return self.loop.run_in_executor(None, functools.partial(func, *args))
+
+    def _on_notification(self, handle, data):
+        # this is called from gattlib's thread
+        if handle == self.cmd_handle:
+            self.loop.call_soon_threadsafe(self._set_response, data)
+
+    def _set_response(self, data):
+        self.last_data = data
+        if not self.response.done():
+            self.response.set_result(None)
+
+    def _clear_response(self):
+        if self.response.done():
+            self.response = self.loop.create_future()
+
+    async def _ensure_connection(self):
+        if not self.connection.is_connected():
+            self._forget_glyphs()
+            self.mtu_negotiated = False
+            self.stats.connects += 1
+            started = time.perf_counter()
+            try:
+                await self._in_thread(self.connection.connect)
+            except Exception:
+                # will sometimes throw if already trying to connect
+                pass
+            for _ in range(50):
+                if self.connection.is_connected():
+                    break
+                await asyncio.sleep(0.1)
+            else:
+                self.stats.connect_time += time.perf_counter() - started
+                raise TimeoutError("Timeout exceeded waiting for bluetooth connection.")
+            self.stats.connect_time += time.perf_counter() - started
+        if not self.mtu_negotiated:
+            await self._in_thread(self._negotiate_mtu)
+
+    def _write_steps(self, steps):
+        for step in steps:
+            self._write_data(*step)
+
+    async def _run(self, steps, timeout):
+        response = None
+        error = None
+        while True:
+            # the writes up to the next wait (such as a window of chunks) are made in one executor call
+            writes = []
+            try:
+                step = steps.throw(error) if error is not None else steps.send(response)
+                while step is not None:
+                    writes.append(step)
+                    step = steps.send(None)
+            except StopIteration as stop:
+                if writes:
+                    await self._in_thread(self._write_steps, writes)
+                return stop.value
+            response = None
+            error = None
+            if writes:
+                self._clear_response()
+                await self._in_thread(self._write_steps, writes)
+            # the wait is timed here, as the generator moved on to it before the writes were made
+            started = time.perf_counter()
+            try:
+                response = await self.wait_for_response(timeout)
+                self._clear_response()
+            except TimeoutError as e:
+                error = e
+            self.last_wait = time.perf_counter() - started
+
+    async def send_command(self, command):
+        """
+        Send a control command to the device.
+        Used for basic commands and data sending flow control.
+        """
+        await self._ensure_connection()
+        self._clear_response()
+        await self._in_thread(self.connection.write_cmd, self.cmd_handle, command.serialize())
+
+    async def query_command(self, command, timeout=0.2, attempts=5):
+        """
+        Send a control command to the device and wait for a response.
+        """
+        async with self.lock:
+            return await self._query_command(command, timeout, attempts)
+
+    async def _query_command(self, command, timeout=0.2, attempts=5):
+        self.stats.queries += 1
+        started = time.perf_counter()
+        try:
+            for i in range(attempts + 1):
+                try:
+                    await self._ensure_connection()
+                    self._clear_response()
+                    await self._in_thread(self.connection.write_cmd, self.cmd_handle, command.serialize())
+                    return await self.wait_for_response(timeout)
+                except TimeoutError:
+                    if i == attempts:
+                        raise
+                    self.stats.query_retries += 1
+                    await self._in_thread(self.connection.disconnect)
+        finally:
+            self.stats.query_time += time.perf_counter() - started
+
+    async def wait_for_response(self, timeout=0.2):
+        """
+        Wait for and return a response, usually from a command sent via send_command.
+        """
+        try:
+            # shielded so that a late response is not lost after a timeout
+            await asyncio.wait_for(asyncio.shield(self.response), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Timeout exceeded waiting for GATT response.") from None
+        return getCommandResponse(self.last_data)
+
+    async def _send_data(self, data_command, timeout=0.2, attempts=5, force=False):
+        transfer, *started = self._start_transfer()
+        try:
+            for i in range(attempts + 1):
+                transfer.attempts += 1
+                try:
+                    await self._ensure_connection()
+                    transfer.sent = await self._run(self._data_transfer(data_command, force, transfer), timeout)
+                    return transfer.sent
+                except (TimeoutError, TransferError):
+                    if i == attempts:
+                        raise
+                    self._shrink_chunks()
+                    if not self.profile_validated:
+                        # the cached profile may be out of date
+                        await self._ensure_connection()
+                        await self._refresh_profile()
+                    # restart on the same connection first, then reconnect
+                    elif i > 0 or not self.connection.is_connected():
+                        await self._in_thread(self.connection.disconnect)
+        except Exception as e:
+            transfer.error = e
+            raise
+        finally:
+            self._finish_transfer(transfer, *started)
+
+    async def send_data(self, data_command, timeout=0.2, attempts=5, force=False):
+        """
+        Send a data command to the device.
+        Returns False if the data was skipped because the device already has it
+        (see skip_unchanged), unless force is set.
+        """
+        async with self.lock:
+            return await self._send_data(data_command, timeout, attempts, force)
+
+    async def set_brightness(self, brightness):
+        """
+        Sets the display brightness. 0 is lowest and 100 is highest.
+        """
+        await self.send_data(self._brightness_command(brightness))
+        self.brightness = brightness
+
+    async def set_screen_mode(self, mode: ScreenMode):
+        """
+        This allows flipping and mirroring the display. See ScreenMode Enum.
+        """
+        await self.send_data(SendDataCommand(ScreenModeData(mode.value)))
+
+    async def set_number_bars(self, values):
+        """
+        Graphs 16 values from 0-12 as a bar graph, such as a music spectrum.
+        """
+        await self.send_data(self._number_bars_command(values))
+
+    async def set_text_by_chars(self, text, effect=Effect.SCROLL_LEFT, font="6x12", speed=0, char_limit=72):
+        """
+        Sends text as characters, uploading only the glyphs the device does not have yet.
+        """
+        if len(text) > char_limit:
+            raise ValueError("The text exceeds the device character limit.")
+
+        font_data = find_and_load_font(font)
+        async with self.lock:
+            await self._ensure_connection()
+            font_command, chars, glyph_key = self._glyph_upload(text, font_data)
+            if font_command is not None:
+                await self._send_data(font_command)
+                self._set_resident(chars, glyph_key)
+
+            await self._send_data(SendDataCommand(TextData(text, speed, effect)))
+
+    async def set_text_lines(self, text, align=Align.CENTER, font="4x6", frame_duration=2, line_height=6,
+            effect=Effect.NONE, speed=20, reflow=True, sequence=False):
+        """
+        Sends multi-line text as an animation. Can pack two lines of text onto the display.
+
+        With sequence, text longer than the device frame limit is played in segments
+        (see spotled.sequencer.play_sequence), returning once the last one is on screen.
+        """
+        if sequence:
+            from .sequencer import play_sequence
+            await play_sequence(self, render_text_lines(
+                text, self.width, self.height, None, align, font, frame_duration, line_height, effect,
+                speed, reflow
+            ))
+            return
+        await self.send_data(SendDataCommand(render_text_lines(
+            text, self.width, self.height, self.frame_limit, align, font, frame_duration,
+            line_height, effect, speed, reflow
+        )))
+
+    async def set_text(self, text, effect=Effect.SCROLL_LEFT, font="6x12", speed=0):
+        """
+        Sends single-line scrolling text as an animation.
+        """
+        await self.send_data(SendDataCommand(render_text(
+            text, self.width, self.height, self.frame_limit, effect, font, speed
+        )))
+
+    async def set_image(self, source, fit='contain', dither=None, threshold=128, invert=False,
+            effect=Effect.NONE, speed=20, frame_duration=None):
+        """
+        Sends an image or animated GIF (a path, file or PIL image) as an animation. Needs Pillow and numpy.
+        """
+        from .image import image_to_animation
+        await self.send_data(SendDataCommand(image_to_animation(
+            source, self.width, self.height, self.color_depth, self.frame_limit, fit, dither,
+            threshold, invert, effect, speed, frame_duration
+        )))
+
+    async def clear(self):
+        """
+        Clears the display by sending an empty frame.
+        """
+        await self.send_data(self._clear_command())
+
+    async def disconnect(self):
+        await self._in_thread(self.connection.disconnect)
@@ -0,0 +1,120 @@
+"""
+Rendering many messages at once across a process pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from . import Align, Effect, DisplayInfoResponse, find_and_load_font, render_text_lines, render_text
+from .blob import Blob
+
+
+class RenderJob:
+    """
+    A message to render for a display profile. Lines are rendered like
+    set_text_lines, and text (scroll=True) like set_text.
+    """
+    def __init__(self, text, width=48, height=12, frame_limit=None, align=Align.CENTER, font=None,
+            frame_duration=2, line_height=6, effect=None, speed=None, reflow=True, scroll=False,
+            color_depth=DisplayInfoResponse.COLOR_MONOCHROME):
+        self.text = text
+        self.width = width
+        self.height = height
+        self.frame_limit = frame_limit
+        self.align = align
+        self.font = font if font is not None else ('6x12' if scroll else '4x6')
+        self.frame_duration = frame_duration
+        self.line_height = line_height
+        self.effect = effect if effect is not None else (Effect.SCROLL_LEFT if scroll else Effect.NONE)
+        self.speed = speed if speed is not None else (0 if scroll else 20)
+        self.reflow = reflow
+        self.scroll = scroll
+        self.color_depth = color_depth
+
+    def render(self):
+        """
+        Renders the message as an AnimationData record.
+        """
+        if self.scroll:
+            return render_text(self.text, self.width, self.height, self.frame_limit, self.effect,
+                self.font, self.speed)
+        return render_text_lines(self.text, self.width, self.height, self.frame_limit, self.align,
+            self.font, self.frame_duration, self.line_height, self.effect, self.speed, self.reflow)
+
+
+class RenderResult:
+    """
+    The serialized payload of a RenderJob, or the error rendering it raised.
+    """
+    def __init__(self, index, job, payload=None, error=None):
+        self.index = index
+        self.job = job
+        self.payload = payload
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def blob(self):
+        """
+        Returns the payload as a Blob which can be saved and sent later.
+        """
+        if self.error is not None:
+            raise self.error
+        job = self.job
+        return Blob(self.payload, job.width, job.height, job.frame_limit or 0, job.color_depth)
+
+    def __repr__(self):
+        if self.error is not None:
+            return f'RenderResult({self.index}, error={self.error!r})'
+        return f'RenderResult({self.index}, {len(self.payload)} bytes)'
+
+
+def _render(job):
+    try:
+        return job.render().serialize(), None
+    except Exception as e:
+        return None, e
+
+
+def _render_chunk(jobs):
+    return [_render(job) for job in jobs]
+
+
+def _load_fonts(fonts):
+    # each worker parses the fonts once, up front
+    for font in fonts:
+        find_and_load_font(font)
+
+
+def render_batch(jobs, max_workers=None, chunk_size=None):
+    """
+    Renders RenderJobs across a pool of processes and yields a RenderResult
+    for each one, in the order of the jobs, as soon as it (and every job
+    before it) has been rendered. A job that fails doesn't stop the batch,
+    its result holds the error instead.
+
+    Jobs are sent to the workers in chunks of chunk_size. With a single
+    worker (or very few jobs), everything is rendered in this process.
+    """
+    jobs = list(jobs)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(jobs)))
+    if chunk_size is None:
+        # a few chunks per worker, so that the results start streaming early
+        chunk_size = max(1, min(64, len(jobs) // (max_workers * 4)))
+
+    if max_workers == 1:
+        for index, job in enumerate(jobs):
+            yield RenderResult(index, job, *_render(job))
+        return
+
+    fonts = sorted({job.font for job in jobs})
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    index = 0
+    with ProcessPoolExecutor(max_workers, initializer=_load_fonts, initargs=(fonts,)) as executor:
+        for chunk, results in zip(chunks, executor.map(_render_chunk, chunks)):
+            for job, (payload, error) in zip(chunk, results):
+                yield RenderResult(index, job, payload, error)
+                index += 1
@@ -0,0 +1,231 @@
+"""
+Benchmarks for the render, serialize and transfer stages.
+
+Run with `python -m spotled.bench`. Use --output to save the results as JSON
+and --compare to print the change relative to a previously saved run.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import os.path
+
+from . import (
+    FONT_DIR, find_and_load_font, parse_font, reflow_text, lines_to_frames, rasterize_lines,
+    gen_bitmap, gen_color_bitmap, pack_color_bitmap, FrameData, AnimationData, TextData, NumberBarData, NumberBarTemplate,
+    SendDataCommand, Effect, Align, LedConnection
+)
+from .simulator import SimulatedDevice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SAMPLE_TEXT = (
+    "A long time ago in a galaxy far, far away.... It is a period of civil war. "
+    "Rebel spaceships, striking from a hidden base, have won their first victory."
+)
+
+
+class Benchmark:
+    """
+    A single benchmark case. The function is called once per operation and
+    returns the number of bytes it produced (or None).
+    """
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def run(self, min_time=0.5, min_iterations=5):
+        self.func() # warm up
+        iterations = 0
+        total_bytes = 0
+        start = time.perf_counter()
+        while True:
+            produced = self.func()
+            iterations += 1
+            total_bytes += produced or 0
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time and iterations >= min_iterations:
+                break
+
+        tracemalloc.start()
+        try:
+            self.func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'iterations': iterations,
+            'seconds': elapsed,
+            'ops_per_sec': iterations / elapsed,
+            'bytes_per_sec': total_bytes / elapsed,
+            'peak_alloc_bytes': peak,
+        }
+
+
+def default_benchmarks():
+    font_4x6 = find_and_load_font('4x6')
+    lines = reflow_text(SAMPLE_TEXT, font_4x6, 48)
+    frames = lines_to_frames(lines, font_4x6, Align.CENTER, 48, 2, 6)
+    frame_data = [FrameData(48, 12, gen_bitmap(*frame)) for frame in frames]
+    animation = AnimationData(frame_data, 2000, 20, Effect.NONE)
+    text = TextData(SAMPLE_TEXT[:72], 0, Effect.SCROLL_LEFT)
+    color_lines = ['RRGGBB..' * 6] * 12
+    color_map = {'.': (0, 0, 0), 'R': (0, 0, 255), 'G': (0, 255, 0), 'B': (255, 0, 0)}
+
+    device = SimulatedDevice()
+    connection = LedConnection(device.address, requester=device)
+    large_mtu_device = SimulatedDevice(max_mtu=247, buffer_size=512)
+    large_mtu_connection = LedConnection(large_mtu_device.address, requester=large_mtu_device)
+
+    def load_font():
+        find_and_load_font('6x12')
+
+    def parse_yaff():
+        parse_font(os.path.join(FONT_DIR, '6x12.yaff'))
+
+    def load_bundle():
+        font = parse_font(os.path.join(FONT_DIR, '6x12.spf'))
+        for char in SAMPLE_TEXT:
+            font.get(char)
+
+    def reflow():
+        reflow_text(SAMPLE_TEXT, font_4x6, 48)
+
+    def to_frames():
+        lines_to_frames(lines, font_4x6, Align.CENTER, 48, 2, 6)
+
+    def rasterize():
+        return sum(len(frame) for frame in rasterize_lines(lines, font_4x6, Align.CENTER, 48, 2, 6))
+
+    def bitmap():
+        return sum(len(gen_bitmap(*frame)) for frame in frames)
+
+    if np is not None:
+        frame_arrays = [np.array([[c == '1' for c in row] for row in frame]) for frame in frames]
+
+    def bitmap_array():
+        return sum(len(gen_bitmap(frame)) for frame in frame_arrays)
+
+    def color_bitmap():
+        return len(gen_color_bitmap(*color_lines, color_map=color_map))
+
+    if np is not None:
+        palette = list(color_map.values())
+        color_indices = np.array([[list(color_map).index(c) for c in row] for row in color_lines])
+        color_array = pack_color_bitmap(color_indices, palette)[:, :, ::-1].copy()
+
+    def color_bitmap_palette():
+        return pack_color_bitmap(color_indices, palette).nbytes
+
+    def color_bitmap_rgb():
+        return pack_color_bitmap(color_array).nbytes
+
+    def serialize_animation():
+        return len(animation.serialize())
+
+    def serialize_text():
+        return len(text.serialize())
+
+    bar_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 11, 10, 9]
+    bar_template = NumberBarTemplate()
+
+    def number_bars():
+        return len(SendDataCommand(NumberBarData(bar_values)).to_buffer())
+
+    def number_bars_template():
+        return len(bar_template.set_values(bar_values).to_buffer())
+
+    def set_text_lines():
+        connection.set_text_lines(SAMPLE_TEXT)
+        return len(device.payloads[-1])
+
+    def set_text_lines_large_mtu():
+        large_mtu_connection.set_text_lines(SAMPLE_TEXT)
+        return len(large_mtu_device.payloads[-1])
+
+    return [
+        Benchmark('find_and_load_font', load_font),
+        Benchmark('parse_font (yaff)', parse_yaff),
+        Benchmark('parse_font (bundle)', load_bundle),
+        Benchmark('reflow_text', reflow),
+        Benchmark('lines_to_frames', to_frames),
+        Benchmark('rasterize_lines', rasterize),
+        Benchmark('gen_bitmap', bitmap),
+        *([Benchmark('gen_bitmap (numpy)', bitmap_array)] if np is not None else []),
+        Benchmark('gen_color_bitmap', color_bitmap),
+        *([Benchmark('pack_color_bitmap (palette)', color_bitmap_palette),
+            Benchmark('pack_color_bitmap (rgb)', color_bitmap_rgb)] if np is not None else []),
+        Benchmark('AnimationData.serialize', serialize_animation),
+        Benchmark('TextData.serialize', serialize_text),
+        Benchmark('NumberBarData command', number_bars),
+        Benchmark('NumberBarTemplate', number_bars_template),
+        Benchmark('set_text_lines', set_text_lines),
+        Benchmark('set_text_lines (mtu 247)', set_text_lines_large_mtu),
+    ]
+
+
+def run(benchmarks, min_time=0.5, only=None):
+    results = {}
+    for benchmark in benchmarks:
+        if only and not any(name in benchmark.name for name in only):
+            continue
+        results[benchmark.name] = benchmark.run(min_time)
+    return {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def format_results(report, baseline=None):
+    header = f"{'benchmark':<26}{'ops/sec':>12}{'bytes/sec':>14}{'peak alloc':>12}"
+    if baseline is not None:
+        header += f"{'change':>10}"
+    out = [header]
+    for name, result in report['results'].items():
+        line = (
+            f"{name:<26}{result['ops_per_sec']:>12.1f}"
+            f"{result['bytes_per_sec']:>14.0f}{result['peak_alloc_bytes']:>12}"
+        )
+        if baseline is not None:
+            old = baseline['results'].get(name)
+            if old is not None and old['ops_per_sec']:
+                line += f"{result['ops_per_sec'] / old['ops_per_sec']:>9.2f}x"
+            else:
+                line += f"{'-':>10}"
+        out.append(line)
+    return '\n'.join(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m spotled.bench', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--min-time', type=float, default=0.5, help='minimum seconds to run each benchmark')
+    parser.add_argument('--only', action='append', help='only run benchmarks containing this name')
+    parser.add_argument('--output', help='save results as JSON to this file')
+    parser.add_argument('--compare', help='compare against results previously saved with --output')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    report = run(default_benchmarks(), args.min_time, args.only)
+    print(format_results(report, baseline))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Precompiled payloads which can be sent without rendering anything.
+
+A blob holds a serialized data record (such as an AnimationData) along with
+the display profile it was rendered for and a hash of its content. Sending
+it only wraps it in a SendDataCommand.
+
+Layout (all values big endian):
+    magic       4 bytes     b'SPBL'
+    version     short
+    width       short
+    height      short
+    frame limit byte
+    color depth byte
+    length      int         length of the content
+    digest      16 bytes    blake2b digest of the content
+    content     the serialized record
+"""
+import hashlib
+import struct
+
+from . import SendDataCommand, data_kind
+
+MAGIC = b'SPBL'
+VERSION = 1
+EXTENSION = '.spb'
+
+_HEADER = struct.Struct('>4sHHHBBI16s')
+# length, type and (for animations) frame count of the first record
+_RECORD = struct.Struct('>IHH')
+_ANIMATION_TYPE = 11
+
+
+def content_digest(content):
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+class Blob:
+    """
+    A serialized record and the display profile it was rendered for.
+    """
+    def __init__(self, content, width, height, frame_limit, color_depth):
+        self.content = bytes(content)
+        self.width = width
+        self.height = height
+        self.frame_limit = frame_limit
+        self.color_depth = color_depth
+        self.digest = content_digest(self.content)
+
+    @property
+    def kind(self):
+        return data_kind(self.content)
+
+    @property
+    def frame_count(self):
+        """
+        The number of frames of an animation, or 0 for other records.
+        """
+        if len(self.content) < _RECORD.size:
+            return 0
+        _, record_type, frames = _RECORD.unpack_from(self.content, 0)
+        return frames if record_type == _ANIMATION_TYPE else 0
+
+    def command(self):
+        return SendDataCommand(self.content)
+
+    def fits(self, connection):
+        """
+        Whether the blob was rendered for the display of a connection
+        and has no more frames than the device can hold. Other records
+        (fonts, brightness, screen mode) fit any device.
+        """
+        if self.kind != 'display':
+            return True
+        return (self.width, self.height) == (connection.width, connection.height) \
+            and self.frame_count <= connection.frame_limit and self.color_depth == connection.color_depth
+
+    def save(self, path):
+        with open(path, 'wb') as fh:
+            fh.write(_HEADER.pack(MAGIC, VERSION, self.width, self.height, self.frame_limit,
+                self.color_depth, len(self.content), self.digest))
+            fh.write(self.content)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        if len(data) < _HEADER.size:
+            raise ValueError('Not a payload blob.')
+        magic, version, width, height, frame_limit, color_depth, length, digest = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a payload blob.')
+        if version != VERSION:
+            raise ValueError(f'Unsupported payload blob version {version}.')
+
+        content = data[_HEADER.size:_HEADER.size + length]
+        if len(content) != length or content_digest(content) != digest:
+            raise ValueError('The payload blob is corrupted.')
+        return cls(content, width, height, frame_limit, color_depth)
+
+
+def save_blob(record, path, width, height, frame_limit, color_depth):
+    """
+    Serializes a data record (or already serialized data) into a blob file.
+    """
+    if not isinstance(record, (bytes, bytearray, memoryview)):
+        record = record.serialize()
+    blob = Blob(record, width, height, frame_limit, color_depth)
+    blob.save(path)
+    return blob
+
+
+def load_blob(path):
+    return Blob.load(path)
@@ -0,0 +1,407 @@
+"""
+Recording the traffic between LedConnection and a device, and replaying it.
+
+CaptureRecorder wraps a requester (such as gattlib's GATTRequester) and logs
+every call made on it and every notification and connect callback it makes,
+with timestamps. CaptureReplay is a requester which plays such a capture back:
+each call is checked against the next call in the capture, and the
+notifications which followed it are delivered with their original delays
+(optionally scaled).
+
+Inspect a capture with `python -m spotled.capture capture.spcap`.
+
+Layout (all values big endian):
+    magic       4 bytes     b'SPCP'
+    version     short
+    connected   byte        whether the requester was connected when recording started
+    events      time (double, seconds since the start), kind (byte), flags (byte),
+                handle (short), data length (int), data
+"""
+import argparse
+import heapq
+import json
+import struct
+import threading
+import time
+
+MAGIC = b'SPCP'
+VERSION = 1
+EXTENSION = '.spcap'
+
+_HEADER = struct.Struct('>4sHB')
+_EVENT = struct.Struct('>dBBHI')
+_MTU = struct.Struct('>H')
+
+# calls made by the client
+WRITE_CMD = 1
+WRITE_BY_HANDLE = 2
+CONNECT = 3
+DISCONNECT = 4
+EXCHANGE_MTU = 5
+DISCOVER_PRIMARY = 6
+DISCOVER_CHARACTERISTICS = 7
+# callbacks made by the device
+NOTIFICATION = 16
+CONNECTED = 17
+
+# the device made the callback from within a call, before it returned
+INLINE = 1
+
+EVENT_NAMES = {
+    WRITE_CMD: 'write_cmd',
+    WRITE_BY_HANDLE: 'write_by_handle',
+    CONNECT: 'connect',
+    DISCONNECT: 'disconnect',
+    EXCHANGE_MTU: 'exchange_mtu',
+    DISCOVER_PRIMARY: 'discover_primary',
+    DISCOVER_CHARACTERISTICS: 'discover_characteristics',
+    NOTIFICATION: 'notification',
+    CONNECTED: 'connected',
+}
+
+
+class CaptureEvent:
+    def __init__(self, time, kind, handle, data, flags=0):
+        self.time = time
+        self.kind = kind
+        self.handle = handle
+        self.data = data
+        self.flags = flags
+
+    @property
+    def from_device(self):
+        return self.kind >= NOTIFICATION
+
+    def __repr__(self):
+        return f'CaptureEvent({self.time:.6f}, {EVENT_NAMES.get(self.kind, self.kind)}, {self.handle:#06x}, {self.data.hex()})'
+
+
+class Capture:
+    """
+    A recorded list of CaptureEvents.
+    """
+    def __init__(self, events=None, connected=False):
+        self.events = events if events is not None else []
+        self.connected = connected
+
+    def save(self, path):
+        with open(path, 'wb') as fh:
+            fh.write(_HEADER.pack(MAGIC, VERSION, self.connected))
+            for event in self.events:
+                fh.write(_EVENT.pack(event.time, event.kind, event.flags, event.handle, len(event.data)))
+                fh.write(event.data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        magic, version, connected = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a capture file.')
+        if version != VERSION:
+            raise ValueError(f'Unsupported capture version {version}.')
+
+        events = []
+        pos = _HEADER.size
+        while pos < len(data):
+            event_time, kind, flags, handle, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            events.append(CaptureEvent(event_time, kind, handle, data[pos:pos + length], flags))
+            pos += length
+        return cls(events, bool(connected))
+
+
+def load_capture(path):
+    return Capture.load(path)
+
+
+class CaptureRecorder:
+    """
+    A requester which passes everything through to another requester and
+    records it. Pass it as the requester of a LedConnection and save the
+    capture when done:
+
+        recorder = CaptureRecorder(GATTRequester(address))
+        connection = LedConnection(address, requester=recorder)
+        ...
+        recorder.save('stall.spcap')
+    """
+    def __init__(self, requester):
+        self.requester = requester
+        self.accepts_buffers = getattr(requester, 'accepts_buffers', False)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.capture = Capture(connected=bool(requester.is_connected()))
+        self._on_notification = None
+        self._on_connect = None
+        self._local = threading.local()
+
+    def _record(self, kind, handle=0, data=b''):
+        flags = INLINE if kind >= NOTIFICATION and getattr(self._local, 'in_call', False) else 0
+        event = CaptureEvent(time.perf_counter() - self.start, kind, handle, bytes(data), flags)
+        with self.lock:
+            self.capture.events.append(event)
+        return event
+
+    def _call(self, func, *args, **kwargs):
+        self._local.in_call = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.in_call = False
+
+    @property
+    def on_notification(self):
+        return self._on_notification
+
+    @on_notification.setter
+    def on_notification(self, callback):
+        self._on_notification = callback
+        self.requester.on_notification = self._notification
+
+    def _notification(self, handle, data):
+        self._record(NOTIFICATION, handle, data)
+        if self._on_notification is not None:
+            self._on_notification(handle, data)
+
+    @property
+    def on_connect(self):
+        return self._on_connect
+
+    @on_connect.setter
+    def on_connect(self, callback):
+        self._on_connect = callback
+        self.requester.on_connect = self._connected
+
+    def _connected(self, mtu):
+        self._record(CONNECTED, 0, _MTU.pack(mtu))
+        if self._on_connect is not None:
+            self._on_connect(mtu)
+
+    def connect(self, *args, **kwargs):
+        self._record(CONNECT)
+        return self._call(self.requester.connect, *args, **kwargs)
+
+    def is_connected(self):
+        return self.requester.is_connected()
+
+    def disconnect(self):
+        self._record(DISCONNECT)
+        return self._call(self.requester.disconnect)
+
+    # calls with a result are recorded before they are made, so that callbacks made
+    # during them are recorded after them, and the result is filled in afterwards
+
+    def exchange_mtu(self, mtu):
+        event = self._record(EXCHANGE_MTU, mtu)
+        exchange_mtu = getattr(self.requester, 'exchange_mtu', None)
+        if exchange_mtu is None:
+            raise UnsupportedCall('The requester can not exchange the MTU.')
+        result = self._call(exchange_mtu, mtu)
+        if isinstance(result, int):
+            event.data = _MTU.pack(result)
+        return result
+
+    def discover_primary(self):
+        event = self._record(DISCOVER_PRIMARY)
+        result = self._call(self.requester.discover_primary)
+        event.data = json.dumps(result).encode()
+        return result
+
+    def discover_characteristics(self, *args, **kwargs):
+        event = self._record(DISCOVER_CHARACTERISTICS)
+        result = self._call(self.requester.discover_characteristics, *args, **kwargs)
+        event.data = json.dumps(result).encode()
+        return result
+
+    def write_by_handle(self, handle, data):
+        self._record(WRITE_BY_HANDLE, handle, data)
+        return self._call(self.requester.write_by_handle, handle, data)
+
+    def write_cmd(self, handle, data):
+        self._record(WRITE_CMD, handle, data)
+        return self._call(self.requester.write_cmd, handle, data)
+
+    def save(self, path):
+        with self.lock:
+            self.capture.save(path)
+
+
+class UnsupportedCall(Exception):
+    """
+    Raised for a call the recorded requester did not support, such as exchange_mtu.
+    """
+
+
+class ReplayMismatch(Exception):
+    """
+    Raised by a strict CaptureReplay when the client does something else than what was recorded.
+    """
+
+
+class CaptureReplay:
+    """
+    A requester which plays back a Capture (or capture file). Every call is
+    matched against the next recorded call, and the notifications recorded
+    after it are delivered with their original delays divided by speed. With
+    speed=None they are delivered immediately, from the calling thread, which
+    makes replays fully deterministic. Callbacks the device made from within a
+    call are always made from within the replayed call.
+
+    If strict, a call that differs from the capture raises ReplayMismatch.
+    Otherwise it is counted in mismatches, and replay carries on from the next
+    recorded call of the same kind, handle and data if there is one.
+    """
+    accepts_buffers = True
+
+    def __init__(self, capture, speed=1.0, strict=True, lookahead=64):
+        if not isinstance(capture, Capture):
+            capture = Capture.load(capture)
+        self.capture = capture
+        self.speed = speed
+        self.strict = strict
+        self.lookahead = lookahead
+        self.events = capture.events
+        self.pos = 0
+        self.connected = capture.connected
+        self.mismatches = 0
+        self.on_notification = None
+        self.on_connect = None
+
+        self.lock = threading.Condition()
+        self.pending = []
+        self.sequence = 0
+        self.thread = None
+
+    def _matches(self, pos, kind, handle, data):
+        event = self.events[pos]
+        return (not event.from_device and event.kind == kind
+            and (handle is None or event.handle == handle) and (data is None or event.data == data))
+
+    def _next_call(self):
+        for pos in range(self.pos, len(self.events)):
+            if not self.events[pos].from_device:
+                return pos
+        return None
+
+    def _replay(self, kind, handle=None, data=None):
+        """
+        Matches a call against the capture and schedules the device events that followed it.
+        """
+        if data is not None:
+            data = bytes(data)
+        pos = self._next_call()
+        if pos is None or not self._matches(pos, kind, handle, data):
+            self.mismatches += 1
+            if self.strict:
+                recorded = self.events[pos] if pos is not None else 'the end of the capture'
+                got = CaptureEvent(0, kind, handle or 0, data or b'')
+                raise ReplayMismatch(f'Expected {recorded}, got {got}.')
+            end = min(len(self.events), self.pos + self.lookahead)
+            pos = next((i for i in range(self.pos, end) if self._matches(i, kind, handle, data)), None)
+            if pos is None:
+                return None
+
+        call = self.events[pos]
+        self.pos = pos + 1
+        while self.pos < len(self.events) and self.events[self.pos].from_device:
+            event = self.events[self.pos]
+            if event.flags & INLINE:
+                self._deliver(event)
+            else:
+                self._schedule(event, event.time - call.time)
+            self.pos += 1
+        return call
+
+    def _recorded_result(self, kind):
+        call = self._replay(kind)
+        if call is None:
+            raise ReplayMismatch(f'No recorded {EVENT_NAMES[kind]} result.')
+        return json.loads(call.data)
+
+    def _schedule(self, event, delay):
+        if not self.speed:
+            self._deliver(event)
+            return
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.pending, (time.monotonic() + delay / self.speed, self.sequence, event))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='spotled-capture-replay', daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                due, _, event = self.pending[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+                heapq.heappop(self.pending)
+            self._deliver(event)
+
+    def _deliver(self, event):
+        if event.kind == NOTIFICATION:
+            if self.on_notification is not None:
+                self.on_notification(event.handle, event.data)
+        elif event.kind == CONNECTED:
+            self.connected = True
+            if self.on_connect is not None:
+                self.on_connect(_MTU.unpack(event.data)[0])
+
+    @property
+    def finished(self):
+        """
+        Whether every recorded call has been replayed.
+        """
+        return self._next_call() is None
+
+    def connect(self, *args, **kwargs):
+        self._replay(CONNECT)
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self._replay(DISCONNECT)
+        self.connected = False
+
+    def exchange_mtu(self, mtu):
+        call = self._replay(EXCHANGE_MTU, mtu)
+        if call is None or not call.data:
+            raise UnsupportedCall('The recorded requester did not exchange the MTU.')
+        return _MTU.unpack(call.data)[0]
+
+    def discover_primary(self):
+        return self._recorded_result(DISCOVER_PRIMARY)
+
+    def discover_characteristics(self, *args, **kwargs):
+        return self._recorded_result(DISCOVER_CHARACTERISTICS)
+
+    def write_by_handle(self, handle, data):
+        self._replay(WRITE_BY_HANDLE, handle, data)
+
+    def write_cmd(self, handle, data):
+        self._replay(WRITE_CMD, handle, data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m spotled.capture',
+        description='Print the events of a capture file.')
+    parser.add_argument('capture', help='capture file')
+    args = parser.parse_args(argv)
+
+    capture = Capture.load(args.capture)
+    for event in capture.events:
+        direction = '<-' if event.from_device else '->'
+        print(f'{event.time:10.6f} {direction} {EVENT_NAMES.get(event.kind, event.kind):<24} '
+            f'{event.handle:#06x} {event.data.hex()}')
+
+
+if __name__ == '__main__':
+    main()
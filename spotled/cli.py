@@ -0,0 +1,190 @@
+"""
+The spotled command.
+
+    spotled compile lines "Room booked until 3pm" -o booked.spb
+    spotled compile bitmap frames.txt --frame-duration 500 -o logo.spb
+    spotled compile image spinner.gif --dither ordered -o spinner.spb
+    spotled send AA:BB:CC:DD:EE:FF booked.spb
+    spotled info booked.spb
+
+Content is rendered ahead of time for a display profile, given with --width,
+--height, --frame-limit and --color-depth or read from the profile cache of a
+device with --device, and sent later without rendering anything.
+"""
+import argparse
+import sys
+
+from . import (
+    LedConnection, ProfileCache, AnimationData, FrameData, BrightnessData, Align, Effect,
+    DisplayInfoResponse, render_text_lines, render_text, render_clear, gen_bitmap
+)
+from .blob import EXTENSION, save_blob, load_blob
+
+
+def _enum_value(enum):
+    def parse(name):
+        try:
+            return enum[name.upper().replace('-', '_')]
+        except KeyError:
+            raise argparse.ArgumentTypeError(f'must be one of {", ".join(e.name.lower() for e in enum)}')
+    return parse
+
+
+def read_bitmap_frames(path):
+    """
+    Reads frames of . and 1 rows separated by blank lines.
+    """
+    with open(path) as fh:
+        text = fh.read()
+    frames = [[]]
+    for line in text.replace('\r', '').split('\n'):
+        line = line.strip()
+        if line:
+            frames[-1].append(line)
+        elif frames[-1]:
+            frames.append([])
+    return [frame for frame in frames if frame]
+
+
+def render_bitmap(frames, width, height, frame_limit=None, frame_duration=1000, effect=Effect.NONE, speed=20):
+    """
+    Renders frames of . and 1 rows as an AnimationData record.
+    """
+    if frame_limit is not None and len(frames) > frame_limit:
+        raise ValueError("The animation exceeds the device frame limit.")
+    frame_data = []
+    for frame in frames:
+        if len(frame) > height or any(len(row) > width for row in frame):
+            raise ValueError(f'Frames must fit the {width}x{height} display.')
+        rows = frame + ['.' * width] * (height - len(frame))
+        frame_data.append(FrameData(width, height, gen_bitmap(*rows, min_len=width)))
+    return AnimationData(frame_data, frame_duration, speed, effect)
+
+
+def _profile(args):
+    if args.device is not None:
+        profile = ProfileCache(args.profile_cache).get(args.device)
+        if profile is None:
+            sys.exit(f'No cached profile for {args.device}, connect to it with --profile-cache first.')
+        return profile.width, profile.height, profile.frame_limit, profile.color_depth
+    return args.width, args.height, args.frame_limit, args.color_depth
+
+
+def compile_command(args):
+    width, height, frame_limit, color_depth = _profile(args)
+    if args.content == 'lines':
+        record = render_text_lines(args.text, width, height, frame_limit, args.align, args.font,
+            args.frame_duration / 1000, args.line_height, args.effect, args.speed)
+    elif args.content == 'text':
+        record = render_text(args.text, width, height, frame_limit, args.effect, args.font, args.speed)
+    elif args.content == 'bitmap':
+        record = render_bitmap(read_bitmap_frames(args.file), width, height, frame_limit,
+            args.frame_duration, args.effect, args.speed)
+    elif args.content == 'image':
+        from .image import image_to_animation
+        record = image_to_animation(args.file, width, height, color_depth, frame_limit, args.fit,
+            args.dither, args.threshold, args.invert, args.effect, args.speed, args.frame_duration)
+    elif args.content == 'clear':
+        record = render_clear(width, height)
+    else:
+        record = BrightnessData(args.brightness)
+
+    output = args.output or f'{args.content}{EXTENSION}'
+    blob = save_blob(record, output, width, height, frame_limit, color_depth)
+    print(f'{output}: {blob.kind} {len(blob.content)} bytes {blob.digest.hex()}')
+
+
+def send_command(args):
+    blobs = [load_blob(path) for path in args.blobs]
+    connection = LedConnection(args.address, profile_cache=args.profile_cache or None)
+    for path, blob in zip(args.blobs, blobs):
+        if not blob.fits(connection) and not args.ignore_profile:
+            sys.exit(f'{path} has {blob.frame_count} frames for a {blob.width}x{blob.height} display, '
+                f'the device is {connection.width}x{connection.height} with up to {connection.frame_limit}.')
+        connection.send_data(blob.command(), args.timeout, args.attempts)
+        print(f'{path}: {connection.last_transfer}')
+    connection.disconnect()
+
+
+def info_command(args):
+    for path in args.blobs:
+        blob = load_blob(path)
+        print(f'{path}: {blob.kind} {len(blob.content)} bytes, {blob.frame_count} frames for '
+            f'{blob.width}x{blob.height} (frame limit {blob.frame_limit}), color depth {blob.color_depth}, '
+            f'digest {blob.digest.hex()}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='spotled', description='Control SPOTLED bluetooth led displays.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compile_options = argparse.ArgumentParser(add_help=False)
+    compile_options.add_argument('-o', '--output', help=f'output file (default: <content>{EXTENSION})')
+    profile = compile_options.add_argument_group('display profile')
+    profile.add_argument('--width', type=int, default=48)
+    profile.add_argument('--height', type=int, default=12)
+    profile.add_argument('--frame-limit', type=int, default=20)
+    profile.add_argument('--color-depth', type=int, default=DisplayInfoResponse.COLOR_MONOCHROME)
+    profile.add_argument('--device', help='use the cached profile of this device address instead')
+    profile.add_argument('--profile-cache', help='profile cache file for --device')
+
+    compile_parser = commands.add_parser('compile', help='render content into a payload blob')
+    content = compile_parser.add_subparsers(dest='content', required=True)
+
+    for name, help_text in (('lines', 'multi-line text, like set_text_lines'),
+            ('text', 'single-line scrolling text, like set_text')):
+        text_parser = content.add_parser(name, help=help_text, parents=[compile_options])
+        text_parser.add_argument('text')
+        text_parser.add_argument('--font', default='4x6' if name == 'lines' else '6x12')
+        text_parser.add_argument('--effect', type=_enum_value(Effect),
+            default=Effect.NONE if name == 'lines' else Effect.SCROLL_LEFT)
+        text_parser.add_argument('--speed', type=int, default=20 if name == 'lines' else 0)
+        if name == 'lines':
+            text_parser.add_argument('--align', type=_enum_value(Align), default=Align.CENTER)
+            text_parser.add_argument('--frame-duration', type=int, default=2000, help='milliseconds per frame')
+            text_parser.add_argument('--line-height', type=int, default=6)
+
+    bitmap_parser = content.add_parser('bitmap', help='frames of . and 1 rows separated by blank lines',
+        parents=[compile_options])
+    bitmap_parser.add_argument('file')
+    bitmap_parser.add_argument('--frame-duration', type=int, default=1000, help='milliseconds per frame')
+    bitmap_parser.add_argument('--effect', type=_enum_value(Effect), default=Effect.NONE)
+    bitmap_parser.add_argument('--speed', type=int, default=20)
+
+    image_parser = content.add_parser('image', help='an image or animated GIF (needs Pillow and numpy)',
+        parents=[compile_options])
+    image_parser.add_argument('file')
+    image_parser.add_argument('--fit', choices=('contain', 'cover', 'stretch'), default='contain')
+    image_parser.add_argument('--dither', choices=('floyd-steinberg', 'ordered'),
+        help='dither monochrome frames instead of thresholding them')
+    image_parser.add_argument('--threshold', type=int, default=128, help='brightness of lit pixels (0-255)')
+    image_parser.add_argument('--invert', action='store_true')
+    image_parser.add_argument('--frame-duration', type=int, help='milliseconds per frame (default: from the GIF)')
+    image_parser.add_argument('--effect', type=_enum_value(Effect), default=Effect.NONE)
+    image_parser.add_argument('--speed', type=int, default=20)
+
+    content.add_parser('clear', help='an empty frame', parents=[compile_options])
+    brightness_parser = content.add_parser('brightness', help='a brightness setting', parents=[compile_options])
+    brightness_parser.add_argument('brightness', type=int)
+
+    send_parser = commands.add_parser('send', help='send payload blobs to a device')
+    send_parser.add_argument('address')
+    send_parser.add_argument('blobs', nargs='+')
+    send_parser.add_argument('--timeout', type=float, default=0.2)
+    send_parser.add_argument('--attempts', type=int, default=5)
+    send_parser.add_argument('--profile-cache', nargs='?', const=True, default=False,
+        help='cache the device profile (optionally in this file) for a faster startup')
+    send_parser.add_argument('--ignore-profile', action='store_true',
+        help='send blobs even if they were compiled for a different display')
+
+    info_parser = commands.add_parser('info', help='describe payload blobs')
+    info_parser.add_argument('blobs', nargs='+')
+
+    args = parser.parse_args(argv)
+    if args.command == 'send' and isinstance(args.profile_cache, str):
+        args.profile_cache = ProfileCache(args.profile_cache)
+    {'compile': compile_command, 'send': send_command, 'info': info_command}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Sending the same content to many devices at once.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+from . import (
+    LedConnection, SendDataCommand, BrightnessData, ScreenModeData, Align, Effect, ScreenMode,
+    render_text_lines, render_text, render_clear
+)
+
+
+class FleetResult:
+    """
+    The outcome of sending to one device of a fleet. sent is False if the
+    device already had the content (see LedConnection's skip_unchanged).
+    """
+    def __init__(self, address, sent=None, latency=None, error=None):
+        self.address = address
+        self.sent = sent
+        self.latency = latency
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return f'FleetResult({self.address!r}, error={self.error!r})'
+        return f'FleetResult({self.address!r}, sent={self.sent}, latency={self.latency:.3f})'
+
+
+class _FleetDevice:
+    def __init__(self, device):
+        if isinstance(device, str):
+            self.address = device
+            self.connection = None
+        else:
+            self.address = device.address
+            self.connection = device
+        self.lock = Lock()
+
+    def profile(self):
+        c = self.connection
+        return (c.width, c.height, c.color_depth, c.frame_limit)
+
+
+class LedFleet:
+    """
+    A group of devices which are sent the same content in parallel.
+
+    Devices can be LedConnections or addresses. Addresses are connected to
+    (with connection_args) the first time something is sent, and again after
+    a failed connection attempt. Content is rendered and serialized once for
+    each distinct (width, height, color_depth, frame_limit) profile, then sent
+    to every device from its own thread. A device that times out or fails only
+    affects its own result.
+    """
+    def __init__(self, devices, max_workers=None, **connection_args):
+        self.devices = [_FleetDevice(device) for device in devices]
+        self.connection_args = connection_args
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or max(len(self.devices), 1))
+
+    @property
+    def connections(self):
+        return [device.connection for device in self.devices if device.connection is not None]
+
+    def _connect(self, device):
+        with device.lock:
+            if device.connection is None:
+                device.connection = LedConnection(device.address, **self.connection_args)
+
+    def connect(self, timeout=None):
+        """
+        Connects to any devices given as addresses which are not connected yet.
+        Returns a FleetResult for each device.
+        """
+        return self._run_all(lambda device: self._connect(device) or None, timeout)
+
+    def _run_all(self, func, timeout):
+        def run(device):
+            start = time.perf_counter()
+            try:
+                sent = func(device)
+                return FleetResult(device.address, sent, time.perf_counter() - start)
+            except Exception as e:
+                return FleetResult(device.address, None, time.perf_counter() - start, e)
+
+        futures = [self.executor.submit(run, device) for device in self.devices]
+        done, _ = wait(futures, timeout)
+        results = []
+        for device, future in zip(self.devices, futures):
+            if future in done:
+                results.append(future.result())
+            else:
+                # the send carries on in the background and the device stays locked until it finishes
+                results.append(FleetResult(device.address, None, timeout,
+                    TimeoutError('Timeout exceeded waiting for the device.')))
+        return results
+
+    def send(self, render, timeout=None, force=False):
+        """
+        Sends content to every device. render is called as
+        render(width, height, color_depth, frame_limit) once per device profile
+        and returns a data record (such as AnimationData) or serialized data.
+        timeout is the overall time to wait for the devices in seconds.
+        Returns a FleetResult for each device.
+        """
+        payloads = {}
+        payloads_lock = Lock()
+
+        def payload_for(profile):
+            with payloads_lock:
+                if profile not in payloads:
+                    try:
+                        content = render(*profile)
+                        if not isinstance(content, (bytes, bytearray, memoryview)):
+                            content = content.serialize()
+                        payloads[profile] = content
+                    except Exception as e:
+                        payloads[profile] = e
+                payload = payloads[profile]
+            if isinstance(payload, Exception):
+                raise payload
+            return payload
+
+        def send_to(device):
+            if device.connection is None:
+                self._connect(device)
+            with device.lock:
+                content = payload_for(device.profile())
+                return device.connection.send_data(SendDataCommand(content), force=force)
+
+        return self._run_all(send_to, timeout)
+
+    def send_data(self, content, timeout=None, force=False):
+        """
+        Sends the same data record or serialized data to every device.
+        """
+        return self.send(lambda *profile: content, timeout, force)
+
+    def set_text_lines(self, text, align=Align.CENTER, font="4x6", frame_duration=2, line_height=6,
+            effect=Effect.NONE, speed=20, reflow=True, timeout=None):
+        """
+        Sends multi-line text as an animation to every device.
+        """
+        return self.send(lambda width, height, color_depth, frame_limit: render_text_lines(
+            text, width, height, frame_limit, align, font, frame_duration, line_height, effect, speed, reflow
+        ), timeout)
+
+    def set_text(self, text, effect=Effect.SCROLL_LEFT, font="6x12", speed=0, timeout=None):
+        """
+        Sends single-line scrolling text as an animation to every device.
+        """
+        return self.send(lambda width, height, color_depth, frame_limit: render_text(
+            text, width, height, frame_limit, effect, font, speed
+        ), timeout)
+
+    def set_brightness(self, brightness, timeout=None):
+        return self.send_data(BrightnessData(brightness), timeout)
+
+    def set_screen_mode(self, mode: ScreenMode, timeout=None):
+        return self.send_data(ScreenModeData(mode.value), timeout)
+
+    def clear(self, timeout=None):
+        return self.send(lambda width, height, color_depth, frame_limit: render_clear(width, height), timeout)
+
+    def close(self):
+        """
+        Disconnects from all devices and stops the worker threads.
+        """
+        for connection in self.connections:
+            connection.disconnect()
+        self.executor.shutdown(wait=False)
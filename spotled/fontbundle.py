@@ -0,0 +1,149 @@
+"""
+A compact binary font format which can be loaded without parsing.
+
+Fonts (.yaff or .draw) are compiled into .spf files holding an index sorted
+by codepoint followed by the packed glyph rows. Loading a compiled font only
+maps the file into memory, and glyphs are decoded the first time they are used.
+
+Compile fonts with `python -m spotled.fontbundle font.yaff [...]`.
+
+Layout (all values big endian):
+    magic       4 bytes     b'SPFB'
+    version     short
+    flags       short       (unused, 0)
+    count       int         number of glyphs
+    index       count * 12  codepoint (int), data offset (int), width (short), height (short)
+    data        packed rows of ceil(width / 8) bytes per row, first pixel in the high bit
+"""
+import argparse
+import mmap
+import os
+import struct
+
+from . import Font, Glyph, parse_font
+
+MAGIC = b'SPFB'
+VERSION = 1
+EXTENSION = '.spf'
+
+_HEADER = struct.Struct('>4sHHI')
+_ENTRY = struct.Struct('>IIHH')
+
+
+def write_font_bundle(font, destination):
+    """
+    Writes a parsed font as a font bundle.
+    """
+    chars = sorted(font, key=ord)
+    data_start = _HEADER.size + _ENTRY.size * len(chars)
+
+    index = bytearray()
+    data = bytearray()
+    for char in chars:
+        glyph = font[char]
+        index.extend(_ENTRY.pack(ord(char), data_start + len(data), glyph.width, glyph.height))
+        data.extend(glyph.pack())
+
+    with open(destination, 'wb') as fh:
+        fh.write(_HEADER.pack(MAGIC, VERSION, 0, len(chars)))
+        fh.write(index)
+        fh.write(data)
+
+
+def compile_font(source, destination=None):
+    """
+    Compiles a .yaff or .draw font into a font bundle next to it
+    (or to destination) and returns the path of the bundle.
+    """
+    if destination is None:
+        destination = os.path.splitext(source)[0] + EXTENSION
+    write_font_bundle(parse_font(source), destination)
+    return destination
+
+
+class BundleFont(Font):
+    """
+    A font loaded from a font bundle. Glyphs are only decoded
+    the first time they are looked up.
+    """
+    def __init__(self, path):
+        super().__init__({}, path)
+        with open(path, 'rb') as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count = _HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a font bundle.')
+        if version != VERSION:
+            raise ValueError(f'Unsupported font bundle version {version}.')
+
+    def _find(self, codepoint):
+        low = 0
+        high = self.count
+        while low < high:
+            mid = (low + high) // 2
+            entry = _ENTRY.unpack_from(self.data, _HEADER.size + mid * _ENTRY.size)
+            if entry[0] < codepoint:
+                low = mid + 1
+            elif entry[0] > codepoint:
+                high = mid
+            else:
+                return entry
+        return None
+
+    def _decode(self, offset, width, height):
+        row_bytes = (width + 7) // 8
+        shift = row_bytes * 8 - width
+        return Glyph(
+            (int.from_bytes(self.data[start:start + row_bytes], 'big') >> shift
+                for start in range(offset, offset + height * row_bytes, row_bytes)),
+            width
+        )
+
+    def __getitem__(self, char):
+        try:
+            return self.glyphs[char]
+        except KeyError:
+            pass
+        entry = self._find(ord(char)) if isinstance(char, str) and len(char) == 1 else None
+        if entry is None:
+            raise KeyError(char)
+        glyph = self._decode(entry[1], entry[2], entry[3])
+        self.glyphs[char] = glyph
+        return glyph
+
+    def __contains__(self, char):
+        return char in self.glyphs or (
+            isinstance(char, str) and len(char) == 1 and self._find(ord(char)) is not None
+        )
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield chr(_ENTRY.unpack_from(self.data, _HEADER.size + i * _ENTRY.size)[0])
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+
+def load_font_bundle(path):
+    return BundleFont(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m spotled.fontbundle',
+        description='Compile .yaff or .draw fonts into font bundles.')
+    parser.add_argument('fonts', nargs='+', help='fonts to compile')
+    parser.add_argument('-o', '--output', help='output file (only with a single font)')
+    args = parser.parse_args(argv)
+
+    if args.output and len(args.fonts) > 1:
+        parser.error('--output can only be used with a single font')
+
+    for font in args.fonts:
+        print(compile_font(font, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Importing images and animated GIFs as animations.
+
+Needs Pillow and numpy. Frames are resized by Pillow and converted with
+numpy: thresholded or dithered for monochrome displays and packed as BGR
+for RGB displays.
+"""
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
+
+from . import np, AnimationData, FrameData, DisplayInfoResponse, Effect, pack_color_bitmap
+
+# 4x4 Bayer matrix for ordered dithering, scaled to thresholds in 0-255
+_BAYER = None
+
+FIT_MODES = ('contain', 'cover', 'stretch')
+DITHER_MODES = (None, 'floyd-steinberg', 'ordered')
+
+# used for still images
+DEFAULT_FRAME_DURATION = 1000
+# animation frames without a delay, or with one of at most MIN_FRAME_DELAY, are shown
+# for DEFAULT_FRAME_DELAY (in milliseconds), like browsers play such GIFs
+DEFAULT_FRAME_DELAY = 100
+MIN_FRAME_DELAY = 10
+
+
+def _require():
+    if Image is None or np is None:
+        raise ImportError('Pillow and numpy are required to import images.')
+
+
+def load_frames(source):
+    """
+    Returns the frames of an image (a path, file or PIL image) as RGB images
+    composited onto black, along with their durations in milliseconds.
+    """
+    _require()
+    image = source if isinstance(source, Image.Image) else Image.open(source)
+    animated = getattr(image, 'n_frames', 1) > 1
+    frames = []
+    for frame in ImageSequence.Iterator(image):
+        if not animated:
+            duration = DEFAULT_FRAME_DURATION
+        else:
+            duration = frame.info.get('duration') or 0
+            if duration <= MIN_FRAME_DELAY:
+                duration = DEFAULT_FRAME_DELAY
+        rgba = frame.convert('RGBA')
+        background = Image.new('RGBA', rgba.size, (0, 0, 0, 255))
+        frames.append((Image.alpha_composite(background, rgba).convert('RGB'), duration))
+    return frames
+
+
+def fit_image(image, width, height, fit='contain'):
+    """
+    Resizes an RGB image to the display. contain keeps the whole image
+    (letterboxed in black), cover fills the display (cropping the image)
+    and stretch ignores the aspect ratio.
+    """
+    if fit not in FIT_MODES:
+        raise ValueError(f'fit must be one of {", ".join(FIT_MODES)}.')
+    if fit == 'stretch' or image.size == (width, height):
+        return image.resize((width, height), Image.LANCZOS)
+
+    scale = (min if fit == 'contain' else max)(width / image.width, height / image.height)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    resized = image.resize(size, Image.LANCZOS)
+    canvas = Image.new('RGB', (width, height))
+    canvas.paste(resized, ((width - size[0]) // 2, (height - size[1]) // 2))
+    return canvas
+
+
+def _bayer_thresholds(width, height):
+    global _BAYER
+    if _BAYER is None:
+        matrix = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]])
+        _BAYER = ((matrix + 0.5) * 16).astype(np.uint8)
+    return np.tile(_BAYER, (height // 4 + 1, width // 4 + 1))[:height, :width]
+
+
+def to_monochrome(image, dither=None, threshold=128, invert=False):
+    """
+    Converts an RGB image to a 2-D boolean array of lit pixels.
+    """
+    if dither not in DITHER_MODES:
+        raise ValueError(f'dither must be one of {", ".join(str(mode) for mode in DITHER_MODES)}.')
+    if dither == 'floyd-steinberg':
+        pixels = np.asarray(image.convert('L').convert('1', dither=Image.FLOYDSTEINBERG))
+    else:
+        gray = np.asarray(image.convert('L'))
+        if dither == 'ordered':
+            pixels = gray > _bayer_thresholds(image.width, image.height)
+        else:
+            pixels = gray >= threshold
+    return ~pixels if invert else pixels
+
+
+def to_bgr(image):
+    """
+    Converts an RGB image to a height x width x 3 array of BGR bytes.
+    """
+    return pack_color_bitmap(np.asarray(image.convert('RGB')))
+
+
+def _convert(image, width, height, rgb, fit, dither, threshold, invert):
+    image = fit_image(image, width, height, fit)
+    if rgb:
+        return to_bgr(image)
+    return to_monochrome(image, dither, threshold, invert)
+
+
+def select_frames(durations, frame_limit):
+    """
+    Picks at most frame_limit frames spread evenly over the running time of
+    an animation, so long-held frames are kept in preference to brief ones.
+    Returns the indices of the picked frames.
+    """
+    if frame_limit is None or len(durations) <= frame_limit:
+        return list(range(len(durations)))
+    ends = np.cumsum(durations)
+    times = (np.arange(frame_limit) + 0.5) * (ends[-1] / frame_limit)
+    return sorted(set(np.searchsorted(ends, times, side='right').tolist()))
+
+
+def image_to_animation(source, width, height, color_depth=DisplayInfoResponse.COLOR_MONOCHROME,
+        frame_limit=20, fit='contain', dither=None, threshold=128, invert=False,
+        effect=Effect.NONE, speed=20, frame_duration=None):
+    """
+    Converts an image or animated GIF into an AnimationData record for a
+    display. Consecutive frames which look the same on the display are merged,
+    and if there are still more than frame_limit frames, they are picked evenly
+    over the running time of the animation. The device shows every frame for
+    the same time, which is frame_duration (in milliseconds) if given, and
+    otherwise the running time divided by the number of frames.
+    """
+    frames = load_frames(source)
+    rgb = color_depth == DisplayInfoResponse.COLOR_RGB
+
+    pixels = []
+    durations = []
+    for image, duration in frames:
+        converted = _convert(image, width, height, rgb, fit, dither, threshold, invert)
+        if pixels and np.array_equal(pixels[-1], converted):
+            durations[-1] += duration
+        else:
+            pixels.append(converted)
+            durations.append(duration)
+
+    picked = select_frames(durations, frame_limit)
+    if frame_duration is None:
+        frame_duration = round(sum(durations) / len(picked))
+    frame_duration = max(0, min(0xffff, frame_duration))
+
+    depth = FrameData.COLOR_DEPTH_RGB if rgb else FrameData.COLOR_DEPTH_MONOCHROME
+    frame_data = [FrameData(width, height, pixels[i], depth) for i in picked]
+    return AnimationData(frame_data, frame_duration, speed, effect)
@@ -0,0 +1,174 @@
+"""
+Non-blocking updates through a background sender thread.
+"""
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+from . import (
+    SendDataCommand, DataTemplate, BrightnessData, ScreenModeData, NumberBarData, Align, Effect, ScreenMode,
+    data_kind, render_text_lines, render_text, render_clear
+)
+
+
+class _Update:
+    def __init__(self, data):
+        self.data = data
+        self.queued_at = time.perf_counter()
+
+
+class SendQueue:
+    """
+    Sends updates to a LedConnection from a dedicated thread, so that callers
+    return immediately. The queue owns the connection while it is running, so
+    don't use the connection directly at the same time.
+
+    Updates that replace the same kind of device state (display contents,
+    font, brightness or screen mode, see data_kind) coalesce: a newer update
+    replaces an older one that has not been sent yet, which is counted as
+    dropped. Updates of an unknown kind are always sent. Pass a key to put
+    to choose how an update coalesces yourself.
+    """
+    def __init__(self, connection, timeout=0.2, attempts=5, on_error=None):
+        self.connection = connection
+        self.timeout = timeout
+        self.attempts = attempts
+        self.on_error = on_error
+
+        self.pending = OrderedDict()
+        self.condition = Condition()
+        self.sending = False
+        self.closed = False
+
+        self.queued = 0
+        self.sent = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_error = None
+        self.last_latency = None
+        self.max_latency = 0
+        self.total_latency = 0
+
+        self.thread = Thread(target=self._run, name='spotled-send-queue', daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        """
+        The number of updates waiting to be sent.
+        """
+        return len(self.pending)
+
+    @property
+    def average_latency(self):
+        """
+        The average time in seconds from queueing an update to the device acknowledging it.
+        """
+        completed = self.sent + self.skipped
+        return self.total_latency / completed if completed else None
+
+    def put(self, data, key=None):
+        """
+        Queues a SendDataCommand, DataTemplate, data record or serialized record. It can also
+        be a function returning one of these, which is called by the sender thread
+        (so it is not called at all if the update is replaced before it is sent).
+        """
+        if key is None and not callable(data):
+            key = data_kind(data)
+        if key is None:
+            key = object() # never coalesces
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The send queue is closed.')
+            if key in self.pending:
+                self.dropped += 1
+                del self.pending[key]
+            self.pending[key] = _Update(data)
+            self.queued += 1
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                _, update = self.pending.popitem(last=False)
+                self.sending = True
+
+            try:
+                data = update.data() if callable(update.data) else update.data
+                if not isinstance(data, (SendDataCommand, DataTemplate)):
+                    data = SendDataCommand(data)
+                sent = self.connection.send_data(data, self.timeout, self.attempts)
+            except Exception as e:
+                self.failed += 1
+                self.last_error = e
+                if self.on_error is not None:
+                    self.on_error(e)
+            else:
+                latency = time.perf_counter() - update.queued_at
+                if sent is False:
+                    self.skipped += 1
+                else:
+                    self.sent += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued updates have been sent.
+        Returns False if the timeout expired first.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.sending, timeout)
+
+    def close(self, flush=True, timeout=None):
+        """
+        Stops the sender thread, after sending the queued updates if flush is set.
+        """
+        with self.condition:
+            if not flush:
+                self.dropped += len(self.pending)
+                self.pending.clear()
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def set_brightness(self, brightness):
+        self.put(BrightnessData(brightness))
+
+    def set_screen_mode(self, mode: ScreenMode):
+        self.put(ScreenModeData(mode.value))
+
+    def set_number_bars(self, values):
+        """
+        Queues a bar graph of up to 16 values from 0-12.
+        """
+        self.put(NumberBarData(values))
+
+    def set_text_lines(self, text, align=Align.CENTER, font="4x6", frame_duration=2, line_height=6,
+            effect=Effect.NONE, speed=20, reflow=True):
+        """
+        Queues multi-line text, which is rendered by the sender thread.
+        """
+        c = self.connection
+        self.put(lambda: render_text_lines(
+            text, c.width, c.height, c.frame_limit, align, font, frame_duration, line_height, effect, speed, reflow
+        ), 'display')
+
+    def set_text(self, text, effect=Effect.SCROLL_LEFT, font="6x12", speed=0):
+        c = self.connection
+        self.put(lambda: render_text(text, c.width, c.height, c.frame_limit, effect, font, speed), 'display')
+
+    def clear(self):
+        c = self.connection
+        self.put(lambda: render_clear(c.width, c.height), 'display')
@@ -0,0 +1,177 @@
+"""
+Playing animations with more frames than a device can hold.
+
+The animation is split into segments of at most frame_limit frames, which
+are sent back to back. Each segment is encoded while the one before it is on
+screen, and its upload is started early by the time uploads have been taking,
+so that it replaces the previous segment just as that one finishes.
+"""
+import asyncio
+import time
+from threading import Event, Thread
+
+from . import AnimationData, DataTemplate, Effect, split_animation
+
+
+def segment_duration(segment, default=None):
+    """
+    How long a segment takes to play through once, in seconds. That is only
+    known for animations without an effect (the frame time times the number of
+    frames); default is returned for the others.
+    """
+    if segment.effects == Effect.NONE:
+        return len(segment.frames) * segment.time / 1000
+    return default
+
+
+def _segments(animation, frame_limit, segment_duration_default):
+    segments = split_animation(animation, frame_limit) if isinstance(animation, AnimationData) else list(animation)
+    if not segments:
+        raise ValueError('There are no segments to play.')
+    if len(segments) > 1 and any(segment_duration(s, segment_duration_default) is None for s in segments):
+        raise ValueError('Animations with an effect need a segment_duration to be sequenced.')
+    return segments
+
+
+class _UploadTimer:
+    """
+    Tracks how fast uploads are and when the next one has to start.
+    """
+    def __init__(self, segment_duration):
+        self.segment_duration = segment_duration
+        self.seconds_per_byte = None
+        self.deadline = None
+        self.last_gap = None
+        self.max_gap = 0
+
+    def shown(self, segment, transfer, next_size):
+        """
+        Records that a segment has just been shown by a transfer. Returns how
+        many seconds to wait before starting to upload next_size bytes, which
+        is 0 when it isn't known how long the segment takes.
+        """
+        now = time.perf_counter()
+        if self.deadline is not None:
+            # positive if the previous segment started over before this one replaced it
+            self.last_gap = now - self.deadline
+            self.max_gap = max(self.max_gap, self.last_gap)
+        # reconnecting isn't part of what the next upload will take
+        rate = (transfer.duration - transfer.connect_time) / transfer.payload_bytes
+        self.seconds_per_byte = rate if self.seconds_per_byte is None else (self.seconds_per_byte + rate) / 2
+        duration = segment_duration(segment, self.segment_duration)
+        if duration is None:
+            # a single segment with an effect, nothing follows it
+            self.deadline = None
+            return 0
+        self.deadline = now + duration
+        return max(0, self.deadline - self.seconds_per_byte * next_size - time.perf_counter())
+
+
+class Sequencer:
+    """
+    Plays an AnimationData record (or a list of segments) on a LedConnection
+    from a background thread, in segments of at most the device frame limit.
+    With loop, it starts over after the last segment until stopped; otherwise
+    the device keeps showing the last segment.
+
+    The device only reports how long animations without an effect take, so
+    segments with an effect need segment_duration (in seconds). The sequencer
+    owns the connection while it is running.
+    """
+    def __init__(self, connection, animation, loop=False, segment_duration=None, timeout=0.2, attempts=5,
+            on_error=None):
+        self.connection = connection
+        self.segments = _segments(animation, connection.frame_limit, segment_duration)
+        self.loop = loop
+        self.timeout = timeout
+        self.attempts = attempts
+        self.on_error = on_error
+
+        self.timer = _UploadTimer(segment_duration)
+        self.played = 0
+        self.error = None
+        self.stopped = Event()
+
+        self.thread = Thread(target=self._run, name='spotled-sequencer', daemon=True)
+        self.thread.start()
+
+    @property
+    def running(self):
+        return self.thread.is_alive()
+
+    @property
+    def last_gap(self):
+        """
+        How late (positive) or early (negative) in seconds the last segment replaced the one before it.
+        """
+        return self.timer.last_gap
+
+    @property
+    def max_gap(self):
+        return self.timer.max_gap
+
+    def _run(self):
+        index = 0
+        command = DataTemplate(self.segments[0])
+        while True:
+            try:
+                self.connection.send_data(command, self.timeout, self.attempts, force=True)
+                self.played += 1
+                segment = self.segments[index]
+
+                index += 1
+                if index == len(self.segments):
+                    if not self.loop or len(self.segments) == 1:
+                        self.timer.shown(segment, self.connection.last_transfer, 0)
+                        return
+                    index = 0
+                # stage the next segment while this one is on screen
+                command = DataTemplate(self.segments[index])
+                delay = self.timer.shown(segment, self.connection.last_transfer, len(command.buffer))
+            except Exception as e:
+                self.error = e
+                if self.on_error is not None:
+                    self.on_error(e)
+                return
+            if self.stopped.wait(delay):
+                return
+
+    def wait(self, timeout=None):
+        """
+        Waits until the last segment has been sent (or the sequencer stopped).
+        Returns False if the timeout expired first.
+        """
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def stop(self, timeout=None):
+        """
+        Stops sending segments. The device keeps showing the current one.
+        """
+        self.stopped.set()
+        return self.wait(timeout)
+
+
+async def play_sequence(connection, animation, loop=False, segment_duration=None, timeout=0.2, attempts=5):
+    """
+    Plays an AnimationData record (or a list of segments) on an
+    AsyncLedConnection, like Sequencer. Returns once the last segment has been
+    sent; with loop, it runs until cancelled.
+    """
+    segments = _segments(animation, connection.frame_limit, segment_duration)
+    timer = _UploadTimer(segment_duration)
+    index = 0
+    command = DataTemplate(segments[0])
+    while True:
+        await connection.send_data(command, timeout, attempts, force=True)
+        segment = segments[index]
+
+        index += 1
+        if index == len(segments):
+            if not loop or len(segments) == 1:
+                timer.shown(segment, connection.last_transfer, 0)
+                return
+            index = 0
+        command = DataTemplate(segments[index])
+        delay = timer.shown(segment, connection.last_transfer, len(command.buffer))
+        await asyncio.sleep(delay)
@@ -0,0 +1,277 @@
+import random
+import struct
+import time
+from threading import RLock, Timer
+
+from . import ByteReader, DisplayInfoResponse
+
+SERVICE_UUID = '0000ff20-0000-1000-8000-00805f9b34fb'
+CMD_UUID = '0000ff21-0000-1000-8000-00805f9b34fb'
+DATA_UUID = '0000ff22-0000-1000-8000-00805f9b34fb'
+
+# Error codes reported in the response to SendingDataFinishCommand
+ERROR_NONE = 0
+ERROR_INCOMPLETE = 1
+ERROR_CHECKSUM = 2
+ERROR_FRAME_LIMIT = 3
+
+
+def _checksum_ok(record):
+    value = sum(record[:-1])
+    if value > 255:
+        value = (~value) + 1
+    return (value & 255) == record[-1]
+
+
+class _Transfer:
+    """
+    State of a data transfer started with SendingDataStartCommand.
+    """
+    def __init__(self, serial_no, command_type, length):
+        self.serial_no = serial_no
+        self.command_type = command_type
+        self.length = length
+        self.received = bytearray()
+        self.window_start = 0
+        self.window_writes = 0
+        self.window_limit = None
+        self.bad_from = None
+
+
+class SimulatedDevice:
+    """
+    An in-process SPOTLED badge. This implements the parts of gattlib's
+    GATTRequester that LedConnection uses and answers on the ff21/ff22
+    handles like a real device, so it can be passed as the requester of a
+    LedConnection to test or benchmark transfers without hardware.
+
+    Data is acknowledged with a ContinueSendingResponse after every window of
+    buffer_size // chunk size writes, counted the way LedConnection does (the
+    chunk size is that of the first chunk of a window, except for a short final
+    chunk, which keeps the size seen before). Written chunks are lost with probability
+    loss, in which case the rest of the window is discarded and continue_from
+    points at the first missing byte. With pause_on_error, such a window is
+    answered with a PauseSendingResponse whose offset is relative to the start
+    of the window instead. Each write blocks for latency seconds.
+
+    The MTU can be raised up to max_mtu with exchange_mtu, while chunks longer
+    than max_chunk_size are always lost (like a device that can't keep up with
+    large writes).
+
+    Notifications can be delivered notification_delay seconds late (from
+    another thread) or lost with probability notification_loss, which makes
+    the client stall waiting for them.
+    """
+    # written data may be any buffer, LedConnection does not need to copy chunks
+    accepts_buffers = True
+
+    def __init__(self, address='00:00:00:00:00:00', mtu=23, max_mtu=None, max_chunk_size=None, buffer_size=120, latency=0, loss=0,
+            width=48, height=12, color_depth=DisplayInfoResponse.COLOR_MONOCHROME, frame_limit=20,
+            brightness=100, font_info=0, device_type=1, device_revision=1, software_revision=1,
+            pause_on_error=False, notification_delay=0, notification_loss=0, seed=None):
+        self.address = address
+        self.mtu = self.default_mtu = mtu
+        self.max_mtu = max_mtu if max_mtu is not None else mtu
+        self.max_chunk_size = max_chunk_size
+        self.buffer_size = buffer_size
+        self.latency = latency
+        self.loss = loss
+        self.width = width
+        self.height = height
+        self.color_depth = color_depth
+        self.frame_limit = frame_limit
+        self.brightness = brightness
+        self.font_info = font_info
+        self.device_type = device_type
+        self.device_revision = device_revision
+        self.software_revision = software_revision
+        self.pause_on_error = pause_on_error
+        self.notification_delay = notification_delay
+        self.notification_loss = notification_loss
+        self.random = random.Random(seed)
+
+        self.service_start = 0x0c
+        self.cmd_handle = 0x0e
+        self.data_handle = 0x11
+        self.service_end = 0x12
+
+        self.on_connect = None
+        self.on_notification = None
+        self.connected = False
+        self.notifications_enabled = False
+
+        self.lock = RLock()
+        self.transfer = None
+        # the chunk size the client was last seen writing
+        self.send_size = None
+        self.payloads = []
+        self.records = {}
+        self.screen_mode = 0
+        self.write_count = 0
+        self.bytes_written = 0
+        self.lost_count = 0
+        self.lost_notifications = 0
+        self.pause_count = 0
+        self.errors = []
+
+    def connect(self, *args, **kwargs):
+        with self.lock:
+            self.connected = True
+            self.mtu = self.default_mtu
+            self.transfer = None
+            self.send_size = None
+        if self.on_connect is not None:
+            self.on_connect(self.mtu)
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        with self.lock:
+            self.connected = False
+            self.transfer = None
+
+    def exchange_mtu(self, mtu):
+        if not self.connected:
+            raise RuntimeError('Not connected.')
+        self.mtu = max(23, min(mtu, self.max_mtu))
+        return self.mtu
+
+    def discover_primary(self):
+        return [{'uuid': SERVICE_UUID, 'start': self.service_start, 'end': self.service_end}]
+
+    def discover_characteristics(self, start=0x0001, end=0xffff, uuid=None):
+        characteristics = [
+            {'uuid': CMD_UUID, 'handle': self.cmd_handle - 1, 'properties': 0x16,
+                'value_handle': self.cmd_handle},
+            {'uuid': DATA_UUID, 'handle': self.data_handle - 1, 'properties': 0x06,
+                'value_handle': self.data_handle},
+        ]
+        return [x for x in characteristics if start <= x['handle'] <= end]
+
+    def write_by_handle(self, handle, data):
+        if handle == self.cmd_handle + 1:
+            self.notifications_enabled = True
+        else:
+            self.write_cmd(handle, data)
+
+    def write_cmd(self, handle, data):
+        if not self.connected:
+            raise RuntimeError('Not connected.')
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.write_count += 1
+            self.bytes_written += len(data)
+            if handle == self.cmd_handle:
+                self._on_command(bytes(data))
+            elif handle == self.data_handle:
+                self._on_data(data)
+
+    def _notify(self, command_type, content):
+        if self.on_notification is None:
+            return
+        if self.notification_loss and self.random.random() < self.notification_loss:
+            self.lost_notifications += 1
+            return
+        data = bytes([0x1b, self.cmd_handle & 255, self.cmd_handle >> 8, len(content) + 2, command_type])
+        if self.notification_delay:
+            Timer(self.notification_delay, self.on_notification, (self.cmd_handle, data + content)).start()
+        else:
+            self.on_notification(self.cmd_handle, data + content)
+
+    def _on_command(self, data):
+        d = ByteReader(data)
+        d.read_byte() # length
+        command = d.read_byte()
+
+        if command == 1: # SendingDataStartCommand
+            serial_no = d.read_short()
+            command_type = d.read_short()
+            length = d.read_int()
+            self.transfer = _Transfer(serial_no, command_type, length)
+            self._notify(2, struct.pack('>HBH', serial_no, ERROR_NONE, command_type))
+        elif command == 3: # SendingDataFinishCommand
+            serial_no = d.read_short()
+            command_type = d.read_short()
+            error_code = self._finish_transfer()
+            self._notify(4, struct.pack('>HBH', serial_no, error_code, command_type))
+        elif command == 16: # GetVersionCommand
+            self._notify(17, struct.pack('>HBHII', 0, 0, self.device_type,
+                self.device_revision, self.software_revision))
+        elif command == 18: # GetDisplayInfoCommand
+            self._notify(19, struct.pack('>HBHHBBBB', 0, 0, self.width, self.height,
+                self.color_depth, self.frame_limit, self.brightness, self.font_info))
+        elif command == 20: # GetBufferSizeCommand
+            self._notify(21, struct.pack('>HBI', 0, 0, self.buffer_size))
+
+    def _on_data(self, data):
+        transfer = self.transfer
+        if transfer is None:
+            return
+
+        if transfer.window_writes == 0:
+            largest = min(self.mtu - 3, self.buffer_size)
+            if transfer.window_start + len(data) < transfer.length or len(data) > (self.send_size or largest):
+                self.send_size = len(data)
+            transfer.window_limit = max(1, self.buffer_size // (self.send_size or largest))
+
+        too_long = self.max_chunk_size is not None and len(data) > self.max_chunk_size
+        if too_long or self.loss and self.random.random() < self.loss:
+            self.lost_count += 1
+            if transfer.bad_from is None:
+                transfer.bad_from = len(transfer.received)
+        elif transfer.bad_from is None:
+            transfer.received.extend(data)
+
+        transfer.window_writes += 1
+        if transfer.window_writes >= transfer.window_limit:
+            offset = None
+            if transfer.bad_from is not None and self.pause_on_error:
+                offset = transfer.bad_from - transfer.window_start
+            transfer.window_writes = 0
+            transfer.bad_from = None
+            transfer.window_start = len(transfer.received)
+            if offset is not None and offset <= 255:
+                self.pause_count += 1
+                self._notify(254, struct.pack('>HHBBH', transfer.serial_no, transfer.command_type,
+                    0, offset, 0))
+            else:
+                self._notify(255, struct.pack('>HHI', transfer.serial_no, transfer.command_type,
+                    len(transfer.received)))
+
+    def _finish_transfer(self):
+        transfer = self.transfer
+        self.transfer = None
+        if transfer is None or len(transfer.received) < transfer.length:
+            return self._error(ERROR_INCOMPLETE)
+
+        payload = bytes(transfer.received[:transfer.length])
+        if not _checksum_ok(payload[:15]):
+            return self._error(ERROR_CHECKSUM)
+
+        records = []
+        pos = 15
+        while pos < len(payload):
+            length = struct.unpack_from('>I', payload, pos)[0]
+            record = payload[pos:pos + length]
+            if length < 7 or len(record) < length or not _checksum_ok(record):
+                return self._error(ERROR_CHECKSUM)
+            records.append(record)
+            pos += length
+
+        record_type = struct.unpack_from('>H', records[0], 4)[0] if records else None
+        if record_type == 11 and struct.unpack_from('>H', records[0], 6)[0] > self.frame_limit:
+            return self._error(ERROR_FRAME_LIMIT)
+        if record_type == 14:
+            self.brightness = records[0][6]
+        if record_type == 15:
+            self.screen_mode = records[0][6]
+
+        self.payloads.append(payload[15:])
+        self.records[record_type] = records
+        return ERROR_NONE
+
+    def _error(self, code):
+        self.errors.append(code)
+        return code
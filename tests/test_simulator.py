@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+import spotled
+from spotled.aio import AsyncLedConnection
+from spotled.simulator import SimulatedDevice
+
+TEXT = "The quick brown fox jumps over the lazy dog " * 3
+TIMEOUT = 0.05
+TRANSFERS = 10
+
+
+def animation():
+    return spotled.render_text_lines(TEXT, 48, 12, 20)
+
+
+def sends(count=TRANSFERS, force=True):
+    return [('send_data', spotled.SendDataCommand(animation()), TIMEOUT, 5, force)] * count
+
+
+def disconnect(device):
+    device.disconnect()
+
+
+def run_sync(device, actions, **kwargs):
+    connection = spotled.LedConnection(device.address, requester=device, **kwargs)
+    for action, *args in actions:
+        if callable(action):
+            action(device)
+        else:
+            getattr(connection, action)(*args)
+    return connection
+
+
+def run_async(device, actions, **kwargs):
+    async def run():
+        connection = await AsyncLedConnection.create(device.address, requester=device, **kwargs)
+        for action, *args in actions:
+            if callable(action):
+                action(device)
+            else:
+                await getattr(connection, action)(*args)
+        return connection
+    return asyncio.run(run())
+
+
+@pytest.fixture(params=[run_sync, run_async], ids=['sync', 'async'])
+def run(request):
+    """
+    Runs a list of (method name, *args) actions on a connection to a device,
+    or calls an action with the device, and returns the connection.
+    """
+    return request.param
+
+
+def check_sent(device, connection, count=TRANSFERS):
+    assert device.payloads == [animation().serialize()] * count
+    assert connection.stats.transfers == count
+    assert connection.stats.failed == 0
+    assert connection.stats.payload_bytes == len(spotled.SendDataCommand(animation()).serialize()) * count
+    assert connection.last_transfer.sent is True
+
+
+def font_payloads(device):
+    return [payload for payload in device.payloads if spotled.data_kind(payload) == 'font']
+
+
+def test_clean_transfers(run):
+    device = SimulatedDevice(seed=1)
+    connection = run(device, sends())
+    check_sent(device, connection)
+    assert device.errors == []
+    assert connection.stats.resumes == 0
+    assert connection.stats.retries == 0
+
+
+def test_loss(run):
+    device = SimulatedDevice(loss=0.03, seed=1)
+    connection = run(device, sends())
+    check_sent(device, connection)
+    assert device.lost_count > 0
+    assert connection.stats.resumes > 0
+    # transfers are only started over when the device rejects them
+    assert connection.stats.retries == len(device.errors)
+
+
+def test_pause_on_error(run):
+    device = SimulatedDevice(loss=0.03, pause_on_error=True, seed=1)
+    connection = run(device, sends())
+    check_sent(device, connection)
+    assert device.pause_count > 0
+    assert connection.stats.resumes >= device.pause_count
+    assert connection.stats.retries == len(device.errors)
+
+
+def test_notification_loss(run):
+    device = SimulatedDevice(notification_loss=0.02, seed=1)
+    connection = run(device, sends())
+    check_sent(device, connection)
+    assert device.lost_notifications > 0
+    assert device.errors == []
+    # nothing is resent while stalled, a transfer waits out its stall retries and starts over
+    assert connection.stats.retries == device.lost_notifications
+    assert connection.stats.wait_time >= TIMEOUT * (connection.stall_retries + 1) * device.lost_notifications
+
+
+def test_max_chunk_size(run):
+    device = SimulatedDevice(max_mtu=247, buffer_size=512, max_chunk_size=100, seed=1)
+    connection = run(device, sends(20))
+    check_sent(device, connection, 20)
+    assert connection.mtu == 247
+    assert device.lost_count > 0
+    assert 0 < connection.chunk_size <= 100
+    # once the chunk size has adapted, transfers go through in one go
+    assert connection.last_transfer.attempts == 1
+    assert connection.last_transfer.resumes == 0
+
+
+def test_skip_unchanged(run):
+    device = SimulatedDevice(seed=1)
+    connection = run(device, sends(3, force=False), skip_unchanged=True)
+    assert device.payloads == [animation().serialize()]
+    assert device.errors == []
+    assert connection.stats.transfers == 3
+    assert connection.stats.skipped == 2
+    assert connection.last_transfer.sent is False
+
+
+def test_resident_glyphs(run):
+    device = SimulatedDevice(seed=1)
+    connection = run(device, [('set_text_by_chars', 'abc'), ('set_text_by_chars', 'abcd')])
+    fonts = font_payloads(device)
+    assert len(fonts) == 2
+    # only the glyph that wasn't on the device yet is sent the second time
+    assert len(fonts[1]) < len(fonts[0])
+    assert set(connection.resident_glyphs) == set('abcd')
+    assert connection.stats.transfers == 4
+
+    device = SimulatedDevice(seed=1)
+    run(device, [('set_text_by_chars', 'abc'), ('set_text_by_chars', 'cba')])
+    assert len(font_payloads(device)) == 1
+
+    # reconnecting forgets the glyphs on the device
+    device = SimulatedDevice(seed=1)
+    run(device, [('set_text_by_chars', 'abc'), (disconnect,), ('set_text_by_chars', 'abc')])
+    assert len(font_payloads(device)) == 2
+    assert device.errors == []